@@ -1,53 +1,255 @@
-import datetime
+import asyncio
 from datetime import timedelta
 import logging
 import voluptuous as vol
-import requests
+import aiohttp
 import hashlib
 import time
-
-from homeassistant.const import (CONF_USERNAME, CONF_PASSWORD, CONF_SCAN_INTERVAL)
+import json
+import random
+import base64
+import collections
+import heapq
+import itertools
+import urllib.parse
+import bisect
+import marshal
+import os
+import array
+import math
+
+from homeassistant.const import (CONF_NAME, CONF_USERNAME, CONF_PASSWORD, CONF_SCAN_INTERVAL,
+                                 EVENT_HOMEASSISTANT_STOP)
 from homeassistant.core import callback
-from homeassistant.helpers import config_validation as cv, discovery
-from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.helpers import config_validation as cv, discovery, entity_registry
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.dispatcher import async_dispatcher_connect, async_dispatcher_send
 from homeassistant.helpers.entity import Entity
-from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.event import async_track_time_interval, async_call_later
+from homeassistant.helpers.storage import Store, STORAGE_DIR
 
 import socketio
 
+# optional: streaming parse of the devices status (the whole body is parsed at once otherwise)
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 """ Setting log """
 _LOGGER = logging.getLogger('shelly_cloud_init')
-_LOGGER.setLevel(logging.DEBUG)
 
 """ This is needed to ensure shelly_cloud_iot library is always updated """
 """ Ref: https://developers.home-assistant.io/docs/en/creating_integration_manifest.html"""
-REQUIREMENTS = ['python-socketio[asyncio_client]']
+REQUIREMENTS = ['python-socketio[asyncio_client]', 'ijson>=3.1']
 
 """ This is needed, it impact on the name to be called in configurations.yaml """
 """ Ref: https://developers.home-assistant.io/docs/en/creating_integration_manifest.html"""
 DOMAIN = 'shelly_cloud'
 
-SIGNAL_DELETE_ENTITY = 'shelly_cloud_delete'
-SIGNAL_UPDATE_ENTITY = 'shelly_cloud_update'
+# signals are keyed by entity id (delete), by account and device id (update) and by account (metrics)
+SIGNAL_DELETE_ENTITY = 'shelly_cloud_delete_{}'
+SIGNAL_UPDATE_ENTITY = 'shelly_cloud_update_{}_{}'
+SIGNAL_UPDATE_METRICS = 'shelly_cloud_metrics_{}'
+SIGNAL_UPDATE_AGGREGATES = 'shelly_cloud_aggregates_{}'
+
+# shared scheduler of the accounts jobs
+DATA_SCHEDULER = DOMAIN + '_scheduler'
+SCHEDULER_TICK = timedelta(seconds=1)
+# random spread of the jobs and device polls (fraction of their interval)
+SCHEDULER_JITTER = 0.1
+JOB_UPDATE_DEVICES = 'update_devices'
+JOB_DISCOVER_DEVICES = 'discover_devices'
+JOB_SAVE_SNAPSHOT = 'save_snapshot'
+JOB_PUBLISH_AGGREGATES = 'publish_aggregates'
+
+SERVICE_DUMP_METRICS = 'dump_metrics'
+EVENT_METRICS = 'shelly_cloud_metrics'
 
 HA_SWITCH = 'switch'
 HA_SENSOR = 'sensor'
 
 DEFAULT_SCAN_INTERVAL = timedelta(seconds=10)
 DEFAULT_SHELLY_CLOUD_DEVICES_SCAN_INTERVAL = timedelta(minutes=15)
+DEFAULT_REQUEST_TIMEOUT = timedelta(seconds=10)
+DEFAULT_NOTIFICATIONS_SCAN_INTERVAL = timedelta(minutes=5)
+DEFAULT_PRIORITY_SCAN_INTERVAL = timedelta(seconds=5)
+DEFAULT_IDLE_SCAN_INTERVAL = timedelta(minutes=1)
+DEFAULT_API_URL = 'https://api.shelly.cloud'
 
 CONF_SHELLY_CLOUD_DEVICES_SCAN_INTERVAL = 'shelly_cloud_devices_scan_interval'
-
+CONF_REQUEST_TIMEOUT = 'request_timeout'
+CONF_API_URL = 'api_url'
+CONF_MAX_PARALLEL_COMMANDS = 'max_parallel_commands'
+CONF_RATE_LIMIT = 'rate_limit'
+CONF_RATE_LIMIT_BURST = 'rate_limit_burst'
+CONF_LOCAL_POLLING = 'local_polling'
+CONF_DIAGNOSTICS = 'diagnostics'
+CONF_TRACE_SAMPLE_RATE = 'debug_trace_sample_rate'
+CONF_PROBE_ENDPOINTS = 'probe_endpoints'
+CONF_NOTIFICATIONS = 'notifications'
+CONF_NOTIFICATIONS_SCAN_INTERVAL = 'notifications_scan_interval'
+CONF_PRIORITY_DEVICES = 'priority_devices'
+CONF_PRIORITY_SCAN_INTERVAL = 'priority_scan_interval'
+CONF_IDLE_SCAN_INTERVAL = 'idle_scan_interval'
+CONF_AGGREGATION = 'aggregation'
+CONF_AGGREGATION_WINDOWS = 'aggregation_windows'
+CONF_SENSOR_FILTERS = 'sensor_filters'
+CONF_DEADBAND = 'deadband'
+CONF_RELATIVE_DEADBAND = 'relative_deadband'
+CONF_MIN_INTERVAL = 'min_interval'
+CONF_MAX_INTERVAL = 'max_interval'
+
+# channel wildcard in the sensors status paths
+SENSOR_PATH_CHANNEL = '*'
+
+# login token persistence (keyed by account namespace)
+STORAGE_VERSION = 1
+STORAGE_KEY_AUTH = '{}.auth'
+
+# local snapshot of devices and status: marshal base file + journal of the changed devices (keyed by account namespace)
+SNAPSHOT_FILE = '{}.snapshot'
+SNAPSHOT_MAGIC = b'SHCS\x01'
+SNAPSHOT_SAVE_INTERVAL = timedelta(minutes=1)
+SNAPSHOT_MAX_JOURNAL_RECORDS = 60
+DEFAULT_TOKEN_LIFETIME = timedelta(days=1)
+TOKEN_REFRESH_MARGIN = timedelta(hours=1)
+
+# commands submitted within this delay (seconds) are dispatched together
+COMMAND_BATCH_DELAY = 0.05
+DEFAULT_MAX_PARALLEL_COMMANDS = 8
+
+# Shelly Cloud API rate limit (requests per second), commands are served before polls
+DEFAULT_RATE_LIMIT = 1.0
+DEFAULT_RATE_LIMIT_BURST = 5
+RATE_LIMIT_MIN_RATE = 0.1
+RATE_LIMIT_MIN_BACKOFF = 1
+RATE_LIMIT_MAX_BACKOFF = 60
+RATE_LIMIT_ERRORS = ('max_req',)
+PRIORITY_COMMAND = 0
+PRIORITY_POLL = 1
+
+# per-device polling: the priority devices and the ones changed within DEVICE_ACTIVE_PERIOD are polled at
+# priority_scan_interval, the offline ones and the ones unchanged for DEVICE_IDLE_PERIOD at idle_scan_interval
+DEVICE_ACTIVE_PERIOD = timedelta(minutes=2)
+DEVICE_IDLE_PERIOD = timedelta(minutes=10)
+# up to this number of due devices, the Shelly Cloud is polled per device instead of with a single all_status
+DEVICE_STATUS_MAX_REQUESTS = 3
+
+# responses up to this size (bytes) are also parsed as a whole while streamed (e.g. errors)
+STREAM_HEAD_SIZE = 65536
+
+# rolling aggregation of the power, current and voltage sensors: per-minute buckets, over the configured windows
+AGGREGATED_SENSORS = ('power', 'current', 'voltage', 'meter_power', 'emeter_power', 'emeter_current', 'emeter_voltage')
+AGGREGATION_BUCKET = timedelta(minutes=1)
+# samples farther apart (e.g. offline device) are not integrated
+AGGREGATION_MAX_GAP = timedelta(minutes=10)
+AGGREGATION_PUBLISH_INTERVAL = timedelta(minutes=1)
+AGGREGATION_SERIES_POINTS = 12
+DEFAULT_AGGREGATION_WINDOWS = [timedelta(hours=1)]
+
+# local (LAN) polling of the devices
+LOCAL_REQUEST_TIMEOUT = 3
+LOCAL_RETRY_INTERVAL = timedelta(minutes=5)
+LOCAL_MAX_PARALLEL_REQUESTS = 16
+
+# upper bounds (seconds) of the latency histograms buckets
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+# one entity debug trace every N is logged
+DEFAULT_TRACE_SAMPLE_RATE = 1
+
+# failed logins are retried with an exponential backoff (seconds)
+LOGIN_MIN_BACKOFF = 30
+LOGIN_MAX_BACKOFF = 1800
+
+NOTIFICATIONS_PATH = '/shelly/wss/sock'
+NOTIFICATIONS_MIN_BACKOFF = 1
+NOTIFICATIONS_MAX_BACKOFF = 300
+# the channel is live (polls slowed down) only if a device change has been received in the last period
+NOTIFICATIONS_LIVE_PERIOD = timedelta(minutes=1)
+
+
+def has_unique_account_names(accounts):
+    # account names are the entity ids and storage namespaces: unique, and at most one account without name
+    names = [account.get(CONF_NAME) for account in accounts]
+    if len(names) != len(set(names)):
+        raise vol.Invalid('Shelly Cloud accounts must have unique names (at most one account without name)')
+    return accounts
+
+
+def has_valid_sensor_filters(sensor_filters):
+    # filters are keyed by sensor type, the max publish interval cannot be shorter than the min one
+    for sensor_type, sensor_filter in sensor_filters.items():
+        if sensor_type not in shelly_cloud_SENSORS_MAP:
+            raise vol.Invalid('Unknown sensor type [' + sensor_type + '], valid types are: ' +
+                              ', '.join(shelly_cloud_SENSORS_MAP))
+        if CONF_MIN_INTERVAL in sensor_filter and CONF_MAX_INTERVAL in sensor_filter and \
+                sensor_filter[CONF_MAX_INTERVAL] < sensor_filter[CONF_MIN_INTERVAL]:
+            raise vol.Invalid('Sensor type [' + sensor_type + '] has max_interval shorter than min_interval')
+    return sensor_filters
+
+
+SENSOR_FILTER_SCHEMA = vol.Schema({
+    vol.Optional(CONF_DEADBAND,
+                 default=0): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_RELATIVE_DEADBAND,
+                 default=0): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_MIN_INTERVAL): cv.time_period,
+    vol.Optional(CONF_MAX_INTERVAL): cv.time_period,
+})
+
+
+ACCOUNT_SCHEMA = vol.Schema({
+    vol.Optional(CONF_NAME): cv.slug,
+    vol.Required(CONF_PASSWORD): cv.string,
+    vol.Required(CONF_USERNAME): cv.string,
+
+    vol.Optional(CONF_SCAN_INTERVAL,
+                 default=DEFAULT_SCAN_INTERVAL): cv.time_period,
+    vol.Optional(CONF_SHELLY_CLOUD_DEVICES_SCAN_INTERVAL,
+                 default=DEFAULT_SHELLY_CLOUD_DEVICES_SCAN_INTERVAL): cv.time_period,
+    vol.Optional(CONF_REQUEST_TIMEOUT,
+                 default=DEFAULT_REQUEST_TIMEOUT): cv.time_period,
+    vol.Optional(CONF_API_URL,
+                 default=DEFAULT_API_URL): cv.url,
+    vol.Optional(CONF_MAX_PARALLEL_COMMANDS,
+                 default=DEFAULT_MAX_PARALLEL_COMMANDS): cv.positive_int,
+    vol.Optional(CONF_RATE_LIMIT,
+                 default=DEFAULT_RATE_LIMIT): vol.All(vol.Coerce(float), vol.Range(min=RATE_LIMIT_MIN_RATE)),
+    vol.Optional(CONF_RATE_LIMIT_BURST,
+                 default=DEFAULT_RATE_LIMIT_BURST): cv.positive_int,
+    vol.Optional(CONF_LOCAL_POLLING,
+                 default=False): cv.boolean,
+    vol.Optional(CONF_DIAGNOSTICS,
+                 default=False): cv.boolean,
+    vol.Optional(CONF_TRACE_SAMPLE_RATE,
+                 default=DEFAULT_TRACE_SAMPLE_RATE): cv.positive_int,
+    vol.Optional(CONF_PROBE_ENDPOINTS,
+                 default=False): cv.boolean,
+    vol.Optional(CONF_NOTIFICATIONS,
+                 default=True): cv.boolean,
+    vol.Optional(CONF_NOTIFICATIONS_SCAN_INTERVAL,
+                 default=DEFAULT_NOTIFICATIONS_SCAN_INTERVAL): cv.time_period,
+    vol.Optional(CONF_PRIORITY_DEVICES,
+                 default=[]): vol.All(cv.ensure_list, [cv.string]),
+    vol.Optional(CONF_PRIORITY_SCAN_INTERVAL,
+                 default=DEFAULT_PRIORITY_SCAN_INTERVAL): cv.time_period,
+    vol.Optional(CONF_IDLE_SCAN_INTERVAL,
+                 default=DEFAULT_IDLE_SCAN_INTERVAL): cv.time_period,
+    vol.Optional(CONF_AGGREGATION,
+                 default=False): cv.boolean,
+    vol.Optional(CONF_AGGREGATION_WINDOWS,
+                 default=DEFAULT_AGGREGATION_WINDOWS): vol.All(cv.ensure_list,
+                                                               [vol.All(cv.time_period,
+                                                                        vol.Range(min=AGGREGATION_BUCKET))]),
+    vol.Optional(CONF_SENSOR_FILTERS,
+                 default={}): vol.All({cv.string: SENSOR_FILTER_SCHEMA}, has_valid_sensor_filters),
+})
+
+# a single account (legacy) or a list of accounts
 CONFIG_SCHEMA = vol.Schema({
-    DOMAIN: vol.Schema({
-        vol.Required(CONF_PASSWORD): cv.string,
-        vol.Required(CONF_USERNAME): cv.string,
-
-        vol.Optional(CONF_SCAN_INTERVAL,
-                     default=DEFAULT_SCAN_INTERVAL): cv.time_period,
-        vol.Optional(CONF_SHELLY_CLOUD_DEVICES_SCAN_INTERVAL,
-                     default=DEFAULT_SHELLY_CLOUD_DEVICES_SCAN_INTERVAL): cv.time_period,
-    })
+    DOMAIN: vol.All(cv.ensure_list, [ACCOUNT_SCHEMA], has_unique_account_names)
 }, extra=vol.ALLOW_EXTRA)
 
 
@@ -62,14 +264,240 @@ async def async_setup(hass, config):
 
     _LOGGER.debug('async_setup() >>> STARTED')
 
-    # create ShellyCloudPlatform instance
-    hass.data[DOMAIN] = ShellyCloudPlatform(hass, config)
+    # one scheduler shared by all the accounts
+    hass.data[DATA_SCHEDULER] = ShellyCloudScheduler(hass)
+
+    # create a ShellyCloudPlatform instance for each account, by namespace
+    hass.data[DOMAIN] = {}
+    for account_config in config[DOMAIN]:
+        platform = ShellyCloudPlatform(hass, config, account_config, hass.data[DATA_SCHEDULER])
+        hass.data[DOMAIN][platform.namespace] = platform
+
+    async def async_dump_metrics(service):
+        metrics = {namespace: platform.get_metrics() for namespace, platform in hass.data[DOMAIN].items()}
+        _LOGGER.warning('Shelly Cloud metrics: ' + json.dumps(metrics, sort_keys=True))
+        hass.bus.async_fire(EVENT_METRICS, metrics)
+
+    # debug service: dump the metrics to the log and as an event
+    hass.services.async_register(DOMAIN, SERVICE_DUMP_METRICS, async_dump_metrics)
+
+    for platform in hass.data[DOMAIN].values():
+        # restore the devices and their entities from the local snapshot (no network I/O)
+        await platform.async_restore()
+
+        # login, get devices and start timers in background: a Shelly Cloud outage does not delay the HA startup
+        hass.async_create_task(platform.async_start())
 
     _LOGGER.debug('async_setup() <<< TERMINATED')
 
     return True
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# SHELLY CLOUD DEVICE STATUS
+# - sensor descriptors, compact device records and the extraction of the sensor values
+#
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class ShellyCloudSensorDescriptor(collections.namedtuple('ShellyCloudSensorDescriptor',
+                                                         ['key', 'path', 'eid', 'uom', 'icon', 'factor', 'decimals'])):
+    # immutable sensor metadata, bound once to each sensor entity
+    # path: keys to the raw value in the device status, SENSOR_PATH_CHANNEL stands for each channel of an array
+    __slots__ = ()
+
+    def scale(self, raw_value):
+        # raw device value -> state value
+        return round(raw_value * self.factor, self.decimals)
+
+
+shelly_cloud_SENSORS_MAP = collections.OrderedDict((descriptor.key, descriptor) for descriptor in (
+    ShellyCloudSensorDescriptor('bat', ('bat', 'value'), 'battery', '%', 'mdi:battery', 1, 2),
+    ShellyCloudSensorDescriptor('hum', ('hum', 'value'), 'humidity', '%', 'mdi:water-percent', 1, 2),
+    ShellyCloudSensorDescriptor('tmp', ('tmp', 'value'), 'temperature', '°C', 'mdi:temperature-celsius', 1, 2),
+    ShellyCloudSensorDescriptor('power', ('power', 'value'), 'power', 'W', 'mdi:flash-outline', 0.001, 2),
+    ShellyCloudSensorDescriptor('current', ('current', 'value'), 'current', 'A', 'mdi:current-ac', 0.001, 2),
+    ShellyCloudSensorDescriptor('voltage', ('voltage', 'value'), 'voltage', 'V', 'mdi:power-plug', 0.1, 2),
+    # meters (e.g. Shelly 1PM, 2.5, Plug): power in W, total energy in Wmin
+    ShellyCloudSensorDescriptor('meter_power', ('meters', SENSOR_PATH_CHANNEL, 'power'),
+                                'meter_power', 'W', 'mdi:flash-outline', 1, 2),
+    ShellyCloudSensorDescriptor('meter_energy', ('meters', SENSOR_PATH_CHANNEL, 'total'),
+                                'meter_energy', 'kWh', 'mdi:counter', 1 / 60000, 3),
+    # energy meters (e.g. Shelly EM, 3EM): total energy in Wh
+    ShellyCloudSensorDescriptor('emeter_power', ('emeters', SENSOR_PATH_CHANNEL, 'power'),
+                                'emeter_power', 'W', 'mdi:flash-outline', 1, 2),
+    ShellyCloudSensorDescriptor('emeter_voltage', ('emeters', SENSOR_PATH_CHANNEL, 'voltage'),
+                                'emeter_voltage', 'V', 'mdi:power-plug', 1, 2),
+    ShellyCloudSensorDescriptor('emeter_current', ('emeters', SENSOR_PATH_CHANNEL, 'current'),
+                                'emeter_current', 'A', 'mdi:current-ac', 1, 2),
+    ShellyCloudSensorDescriptor('emeter_power_factor', ('emeters', SENSOR_PATH_CHANNEL, 'pf'),
+                                'emeter_power_factor', None, 'mdi:angle-acute', 1, 2),
+    ShellyCloudSensorDescriptor('emeter_energy', ('emeters', SENSOR_PATH_CHANNEL, 'total'),
+                                'emeter_energy', 'kWh', 'mdi:counter', 0.001, 3),
+    ShellyCloudSensorDescriptor('emeter_energy_returned', ('emeters', SENSOR_PATH_CHANNEL, 'total_returned'),
+                                'emeter_energy_returned', 'kWh', 'mdi:counter', 0.001, 3),
+    # inputs (e.g. Shelly 1, 2.5, i3)
+    ShellyCloudSensorDescriptor('input', ('inputs', SENSOR_PATH_CHANNEL, 'input'),
+                                'input', None, 'mdi:import', 1, 0),
+))
+
+# top-level status keys holding the sensors (used to tell apart the device status shapes)
+SENSOR_STATUS_KEYS = tuple(collections.OrderedDict.fromkeys(
+    descriptor.path[0] for descriptor in shelly_cloud_SENSORS_MAP.values()))
+
+
+class ShellyCloudSensorFilter(collections.namedtuple('ShellyCloudSensorFilter',
+                                                     ['deadband', 'relative_deadband',
+                                                      'min_interval', 'max_interval'])):
+    # publish filter of a sensor type: deadbands (absolute, and relative to the published value) around the published
+    # value, min / max seconds between two publications (None if not set)
+    __slots__ = ()
+
+    def exceeds(self, value, published_value):
+        # a change is published only if beyond both the deadbands (hysteresis around the published value)
+        change = abs(value - published_value)
+        return change > self.deadband and change > self.relative_deadband * abs(published_value)
+
+
+# no filter: every change is published at once
+SENSOR_FILTER_NONE = ShellyCloudSensorFilter(0, 0, None, None)
+
+
+def get_status_fields():
+    # status fields read by the entities: top-level key -> fields (of the dict, or of each dict of the list)
+    status_fields = collections.OrderedDict((('relays', ['ison']), ('cloud', ['connected', 'enabled'])))
+    for descriptor in shelly_cloud_SENSORS_MAP.values():
+        fields = status_fields.setdefault(descriptor.path[0], [])
+        if descriptor.path[-1] not in fields:
+            fields.append(descriptor.path[-1])
+    return status_fields
+
+
+STATUS_FIELDS = get_status_fields()
+
+
+def prune_device_status(device_status):
+    # compact record of the device status: only the fields read by the entities
+    record = {}
+    for key, fields in STATUS_FIELDS.items():
+        value = device_status.get(key)
+        if isinstance(value, dict):
+            record[key] = {field: value[field] for field in fields if field in value}
+        elif isinstance(value, list):
+            record[key] = [{field: item[field] for field in fields if field in item} if isinstance(item, dict) else {}
+                           for item in value]
+    return record
+
+
+async def async_stream_devices_status(response):
+    # parse the all_status body while it is received, keeping only the compact device records
+    devices_status = {}
+    events = ijson.sendable_list()
+    # floats, not Decimal: the values are stored in float columns and saved with marshal
+    parser = ijson.kvitems_coro(events, 'data.devices_status', use_float=True)
+    head = bytearray()
+    size = 0
+    try:
+        async for chunk in response.content.iter_any():
+            size += len(chunk)
+            if size <= STREAM_HEAD_SIZE:
+                head += chunk
+            parser.send(chunk)
+            for device_id, device_status in events:
+                devices_status[device_id] = prune_device_status(device_status)
+            del events[:]
+        parser.close()
+        for device_id, device_status in events:
+            devices_status[device_id] = prune_device_status(device_status)
+    except ijson.JSONError as e:
+        raise ValueError(str(e))
+    if size > STREAM_HEAD_SIZE:
+        # a large body is a list of devices
+        return {'isok': True, 'data': {'devices_status': devices_status}}, size
+    # a small body can be an error
+    response_data = json.loads(bytes(head))
+    if isinstance(response_data, dict) and response_data.get('isok'):
+        response_data['data']['devices_status'] = devices_status
+    return response_data, size
+
+
+def get_status_value(device_status, path):
+    # follow the path in the device status (KeyError / IndexError / TypeError if missing)
+    value = device_status
+    for key in path:
+        value = value[key]
+    return value
+
+
+def get_status_shape(device_type, device_status):
+    # device model and sensors layout: devices with the same shape share the same extractor
+    shape = [device_type]
+    for key in SENSOR_STATUS_KEYS:
+        value = device_status.get(key)
+        shape.append(len(value) if isinstance(value, list) else value is not None)
+    return tuple(shape)
+
+
+class ShellyCloudSensorExtractor:
+    # sensors of a device shape, compiled once: extracts all the sensor raw values in a single pass
+
+    def __init__(self, device_status):
+        # list of (slot, concrete path), slot = (sensor key, channel or None)
+        self.paths = []
+        # slot -> number of channels of the sensor array (1 for plain sensors)
+        self.channels = {}
+        for descriptor in shelly_cloud_SENSORS_MAP.values():
+            if SENSOR_PATH_CHANNEL in descriptor.path:
+                index = descriptor.path.index(SENSOR_PATH_CHANNEL)
+                try:
+                    channels = len(get_status_value(device_status, descriptor.path[:index]))
+                except (KeyError, IndexError, TypeError):
+                    continue
+                candidates = [((descriptor.key, channel),
+                               descriptor.path[:index] + (channel,) + descriptor.path[index + 1:])
+                              for channel in range(channels)]
+            else:
+                channels = 1
+                candidates = [((descriptor.key, None), descriptor.path)]
+            for slot, path in candidates:
+                try:
+                    get_status_value(device_status, path)
+                except (KeyError, IndexError, TypeError):
+                    continue
+                self.paths.append((slot, path))
+                self.channels[slot] = channels
+
+    def extract(self, device_status):
+        # slot -> raw value
+        values = {}
+        for slot, path in self.paths:
+            try:
+                values[slot] = get_status_value(device_status, path)
+            except (KeyError, IndexError, TypeError):
+                pass
+        return values
+
+
+def format_window(window):
+    # short label of an aggregation window (e.g. 15min, 1h, 1d)
+    seconds = int(window.total_seconds())
+    for unit, size in (('d', 86400), ('h', 3600), ('min', 60)):
+        if seconds % size == 0:
+            return str(seconds // size) + unit
+    return str(seconds) + 's'
+
+
+def get_token_expiry(token):
+    # read the expiry (epoch seconds) from the JWT token payload, a default lifetime otherwise
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return time.time() + DEFAULT_TOKEN_LIFETIME.total_seconds()
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 #
 # SHELLY WEBSOCKET
@@ -96,51 +524,983 @@ async def async_setup(hass, config):
 #       online_status.set_status(true, true, true);
 #       });
 
-async def async_socketio(hass, config):
 
-    _LOGGER.info('async_socketio()')
+def merge_device_status(device_status, delta):
+    # recursively apply an incremental (partial) status to the stored device status
+    for key, value in delta.items():
+        current = device_status.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            merge_device_status(current, value)
+        elif isinstance(value, list) and isinstance(current, list) and len(value) == len(current):
+            for index, item in enumerate(value):
+                if isinstance(item, dict) and isinstance(current[index], dict):
+                    merge_device_status(current[index], item)
+                else:
+                    current[index] = item
+        else:
+            device_status[key] = value
+    return device_status
+
+
+class ShellyCloudNotifications:
+    # Shelly Cloud socket.io notifications channel (push subscriber)
+
+    def __init__(self, hass, platform):
+
+        # home assistant
+        self._hass = hass
+        self._platform = platform
+
+        # socket.io client and status, run task
+        self._sio = None
+        self._stopping = False
+        self._task = None
+        self.connected = False
+
+        # last device change received (monotonic)
+        self._last_notification = None
+
+        # reconnection backoff (seconds)
+        self._backoff = NOTIFICATIONS_MIN_BACKOFF
+
+        # index of the notifications url in use
+        self._url_index = 0
+
+    async def async_run(self):
+
+        _LOGGER.info('async_run() >>> notifications channel STARTED')
+
+        while not self._stopping:
+
+            notifications_urls = self._platform.get_notifications_urls()
+            if not notifications_urls:
+                _LOGGER.warning('async_run() >>> no notifications urls, falling back to polling')
+                return False
+
+            # rotate among the available urls after each failure
+            notifications_url = notifications_urls[self._url_index % len(notifications_urls)]
+
+            # do not let socket.io reconnect by itself: backoff and fallback are handled here
+            self._sio = socketio.AsyncClient(reconnection=False)
+            self._sio.on('connect', self._async_on_connect)
+            self._sio.on('disconnect', self._async_on_disconnect)
+            self._sio.on('message', self._async_on_message)
+            self._sio.on('*', self._async_on_event)
+
+            try:
+                _LOGGER.info('async_run() >>> socketio connecting to ' + notifications_url)
+                await self._sio.connect(notifications_url,
+                                        socketio_path=NOTIFICATIONS_PATH,
+                                        transports=['websocket'])
+                # wait until the connection drops
+                await self._sio.wait()
+            except (socketio.exceptions.ConnectionError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                _LOGGER.warning('async_run() >>> socketio connection to ' + notifications_url + ' failed: ' + str(e))
+                self._url_index += 1
+
+            self.connected = False
+
+            if self._stopping:
+                break
+
+            # reconnect with exponential backoff (jittered), polling takes over in the meanwhile
+            delay = self._backoff * random.uniform(0.5, 1.5)
+            self._backoff = min(self._backoff * 2, NOTIFICATIONS_MAX_BACKOFF)
+            _LOGGER.info('async_run() >>> socketio reconnecting in ' + str(round(delay, 1)) + ' s')
+            await asyncio.sleep(delay)
+
+        _LOGGER.info('async_run() <<< notifications channel TERMINATED')
+
+        return True
+
+    @property
+    def live(self):
+        # connected and device changes are actually received (an authenticated but silent channel is not)
+        return (self.connected and self._last_notification is not None and
+                time.monotonic() - self._last_notification < NOTIFICATIONS_LIVE_PERIOD.total_seconds())
+
+    @callback
+    def start(self):
+        # a background task, not tracked by HA: the channel runs until stopped and must not delay the startup
+        self._task = self._hass.loop.create_task(self.async_run())
+
+    async def async_stop(self, event=None):
+        self._stopping = True
+        if self._sio is not None:
+            await self._sio.disconnect()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def _async_on_connect(self):
+        # on connection - authenticate
+        _LOGGER.info('socketio connected, authenticating')
+        await self._sio.emit('auth', {'name': self._platform.username, 'auth': self._platform.auth})
+        self.connected = True
+        self._backoff = NOTIFICATIONS_MIN_BACKOFF
+
+    async def _async_on_disconnect(self):
+        _LOGGER.info('socketio disconnected, falling back to polling')
+        self.connected = False
+        self._last_notification = None
+
+    async def _async_on_message(self, data):
+        self._handle_notification(data)
+
+    async def _async_on_event(self, event, data=None):
+        self._handle_notification(data)
+
+    @callback
+    def _handle_notification(self, data):
+        # the payload may be a JSON string or an already decoded dict
+        if isinstance(data, str):
+            try:
+                data = json.loads(data)
+            except ValueError:
+                _LOGGER.debug('socketio >>> ignoring message: ' + data)
+                return
+        if not isinstance(data, dict):
+            return
+
+        # full (multi device) status payload
+        if isinstance(data.get('devices_status'), dict):
+            for device_id, delta in data['devices_status'].items():
+                if self._platform.apply_device_status(device_id, delta):
+                    self._last_notification = time.monotonic()
+            return
+
+        # single device delta
+        device_id = data.get('deviceId', data.get('device_id', data.get('id')))
+        delta = data.get('status', data.get('data'))
+        if device_id is not None and isinstance(delta, dict):
+            if self._platform.apply_device_status(str(device_id), delta):
+                self._last_notification = time.monotonic()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# SHELLY CLOUD METRICS
+# - per endpoint latency histograms, payload sizes and error counters
+# - poll duration, devices changed per poll and command round-trip time
+#
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class ShellyCloudHistogram:
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+
+    def record(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.last = value
+
+    def percentile(self, q):
+        # upper bound of the bucket holding the q-th percentile (the max for the last bucket)
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulated = 0
+        for bucket, count in zip(self._buckets, self._counts):
+            cumulated += count
+            if cumulated >= rank:
+                return min(bucket, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95),
+                'max': self.max,
+                'last': self.last,
+                'buckets': {str(bucket): count for bucket, count in zip(self._buckets, self._counts)}}
+
+
+class ShellyCloudMetrics:
+
+    def __init__(self):
+        # endpoint -> latency histogram
+        self.latency = collections.defaultdict(ShellyCloudHistogram)
+        # endpoint -> [count, total bytes, last bytes]
+        self.payload_size = collections.defaultdict(lambda: [0, 0, 0])
+        # endpoint -> error code -> count
+        self.errors = collections.defaultdict(collections.Counter)
+        # polls and commands
+        self.poll_duration = ShellyCloudHistogram()
+        self.devices_changed = None
+        self.command_rtt = ShellyCloudHistogram()
+        self.command_confirmation = ShellyCloudHistogram()
+        self.commands_failed = 0
+
+    def record_request(self, endpoint, latency, size=None):
+        self.latency[endpoint].record(latency)
+        if size is not None:
+            payload_size = self.payload_size[endpoint]
+            payload_size[0] += 1
+            payload_size[1] += size
+            payload_size[2] = size
+
+    def record_error(self, endpoint, code):
+        self.errors[endpoint][str(code)] += 1
+
+    def record_poll(self, duration, devices_changed):
+        self.poll_duration.record(duration)
+        self.devices_changed = devices_changed
+
+    def record_command(self, rtt, success):
+        self.command_rtt.record(rtt)
+        if not success:
+            self.commands_failed += 1
+
+    def record_command_confirmation(self, latency):
+        # from the optimistic state to the command result
+        self.command_confirmation.record(latency)
+
+    @property
+    def errors_count(self):
+        return sum(sum(counter.values()) for counter in self.errors.values())
+
+    def as_dict(self):
+        return {'latency': {endpoint: histogram.as_dict() for endpoint, histogram in self.latency.items()},
+                'payload_size': {endpoint: {'count': count, 'mean': total / count if count else None, 'last': last}
+                                 for endpoint, (count, total, last) in self.payload_size.items()},
+                'errors': {endpoint: dict(counter) for endpoint, counter in self.errors.items()},
+                'poll_duration': self.poll_duration.as_dict(),
+                'devices_changed': self.devices_changed,
+                'command_rtt': self.command_rtt.as_dict(),
+                'command_confirmation': self.command_confirmation.as_dict(),
+                'commands_failed': self.commands_failed}
+
 
-    params = {
-        'secure': True,
-        'reconnection': True,
-        'path': '/shelly/wss/sock',
-    }
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# SHELLY LOCAL TRANSPORT
+# - polls and controls the (Gen1) devices directly on the LAN, using the ip from the Shelly Cloud device list
+# - devices not reachable on the LAN are left to the Shelly Cloud, and retried later
+#
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class ShellyLocalTransport:
+
+    def __init__(self, session, metrics):
+
+        # HTTP transport
+        self._session = session
+        self._metrics = metrics
+        self._timeout = aiohttp.ClientTimeout(total=LOCAL_REQUEST_TIMEOUT)
+        self._semaphore = asyncio.Semaphore(LOCAL_MAX_PARALLEL_REQUESTS)
+
+        # device id -> LAN address (ip or ip:port)
+        self.addresses = {}
+        # device ids answering on the LAN
+        self.reachable = set()
+        # device id -> when (monotonic) an unreachable device is tried again
+        self._retry_at = {}
+
+    def update_addresses(self, devices):
+        # learn the device addresses from the Shelly Cloud device list
+        self.addresses = {device_id: device_info['ip']
+                          for device_id, device_info in devices.items()
+                          if device_info.get('ip')}
+        self.reachable &= self.addresses.keys()
+
+    def is_reachable(self, device_id):
+        return device_id in self.reachable
+
+    def covers(self, device_ids):
+        # True if all the devices are reachable on the LAN
+        return all(device_id in self.reachable for device_id in device_ids)
+
+    async def async_get_devices_status(self, device_ids=None):
+        # poll concurrently the devices (all if None) with a known address, returning {device id: status}
+        now = time.monotonic()
+        if device_ids is None:
+            device_ids = self.addresses
+        device_ids = [device_id for device_id in device_ids
+                      if device_id in self.addresses and
+                      (device_id in self.reachable or self._retry_at.get(device_id, 0) <= now)]
+        results = await asyncio.gather(*[self.async_get_device_status(device_id) for device_id in device_ids])
+        return {device_id: prune_device_status(status)
+                for device_id, status in zip(device_ids, results) if status is not None}
+
+    async def async_get_device_status(self, device_id):
+        return await self._async_request(device_id, '/status')
+
+    async def async_set_device_channel(self, device_id, channel, turn):
+        # True / False if the device answered on the LAN, None otherwise
+        if device_id not in self.reachable:
+            return None
+        data = await self._async_request(device_id, '/relay/' + str(channel) + '?turn=' + turn)
+        if data is None:
+            return None
+        return data.get('ison') == (turn == 'on')
+
+    async def _async_request(self, device_id, path):
+        url = 'http://' + self.addresses[device_id] + path
+        endpoint = 'lan:' + path.split('?')[0]
+        try:
+            async with self._semaphore:
+                start = time.monotonic()
+                async with self._session.get(url, timeout=self._timeout) as response:
+                    response.raise_for_status()
+                    body = await response.read()
+                    self._metrics.record_request(endpoint, time.monotonic() - start, len(body))
+                    data = json.loads(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self._metrics.record_error(endpoint, type(e).__name__)
+            if device_id in self.reachable:
+                _LOGGER.info('device id ' + str(device_id) + ' not reachable on the LAN (' + str(e) +
+                             '), using the Shelly Cloud')
+            self.reachable.discard(device_id)
+            self._retry_at[device_id] = time.monotonic() + LOCAL_RETRY_INTERVAL.total_seconds()
+            return None
+        if device_id not in self.reachable:
+            _LOGGER.info('device id ' + str(device_id) + ' reachable on the LAN')
+            self.reachable.add(device_id)
+        return data
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# SHELLY CLOUD RATE LIMITER
+# - token bucket shared by all the Shelly Cloud requests, lower priority values are served first
+# - adaptive: the rate is halved on rate-limit / 5xx responses and slowly restored on success
+#
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class ShellyCloudRateLimiter:
+
+    def __init__(self, hass, rate, burst):
+
+        # home assistant
+        self._hass = hass
+
+        # token bucket
+        self._max_rate = rate
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+
+        # backoff after a rate-limit / 5xx response
+        self._backoff = RATE_LIMIT_MIN_BACKOFF
+        self._blocked_until = 0
+
+        # waiting requests: heap of (priority, sequence, future)
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+
+        # counters
+        self.counters = {'requests': 0, 'delayed': 0, 'wait_time': 0.0, 'throttled': 0}
+
+    @property
+    def rate(self):
+        return self._rate
+
+    async def async_acquire(self, priority=PRIORITY_POLL):
+        # wait for a token
+        self.counters['requests'] += 1
+        self._refill()
+        now = time.monotonic()
+        if not self._waiters and self._tokens >= 1 and now >= self._blocked_until:
+            self._tokens -= 1
+            return
+        self.counters['delayed'] += 1
+        future = self._hass.loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._schedule_wakeup()
+        await future
+        self.counters['wait_time'] += time.monotonic() - now
+
+    @callback
+    def report_success(self):
+        # additive increase of the rate
+        self._backoff = RATE_LIMIT_MIN_BACKOFF
+        if self._rate < self._max_rate:
+            self._rate = min(self._max_rate, self._rate + self._max_rate * 0.05)
+
+    @callback
+    def report_throttled(self, retry_after=None):
+        # multiplicative decrease of the rate and pause
+        self.counters['throttled'] += 1
+        self._refill()
+        self._rate = max(RATE_LIMIT_MIN_RATE, self._rate / 2)
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = self._backoff
+            self._backoff = min(self._backoff * 2, RATE_LIMIT_MAX_BACKOFF)
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        _LOGGER.warning('Shelly Cloud rate limit hit: pausing ' + str(round(delay, 1)) +
+                        ' s, rate lowered to ' + str(round(self._rate, 2)) + ' req/s')
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    def _schedule_wakeup(self):
+        if self._wakeup is not None or not self._waiters:
+            return
+        now = time.monotonic()
+        delay = max(0, (1 - self._tokens) / self._rate, self._blocked_until - now)
+        self._wakeup = self._hass.loop.call_later(delay, self._release)
+
+    @callback
+    def _release(self):
+        # give the available tokens to the waiters, by priority
+        self._wakeup = None
+        self._refill()
+        if time.monotonic() >= self._blocked_until:
+            while self._waiters and self._tokens >= 1:
+                future = heapq.heappop(self._waiters)[2]
+                if future.done():
+                    # cancelled
+                    continue
+                self._tokens -= 1
+                future.set_result(None)
+        self._schedule_wakeup()
 
-    sio = socketio.AsyncClient(params)
 
-    notifications_urls = hass.data[DOMAIN].get_notifications_urls()
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# SHELLY CLOUD SNAPSHOT
+# - devices and devices status saved on disk, to restore the entities at startup without network I/O
+# - periodic: the changed devices are appended to a journal, compacted (atomically) into the base file
+#
+# ----------------------------------------------------------------------------------------------------------------------
 
-    _LOGGER.info(notifications_urls)
 
-    if len(notifications_urls) > 0:
+class ShellyCloudSnapshot:
 
-        name = hass.data[DOMAIN].username
-        auth = hass.data[DOMAIN].auth
+    def __init__(self, hass, platform):
 
-        notifications_url = notifications_urls[0]
+        # home assistant
+        self._hass = hass
+        self._platform = platform
 
-        _LOGGER.info('socketio connecting to ' + notifications_url)
-        await sio.connect(notifications_url)
-        _LOGGER.info('connected!')
+        # base file and journal
+        self._path = hass.config.path(STORAGE_DIR, SNAPSHOT_FILE.format(platform.namespace))
+        self._journal_path = self._path + '.journal'
+        self._generation = 0
+        self._journal_records = 0
+        self._has_base = False
+        self._lock = asyncio.Lock()
 
-        @sio.on('connect')
-        async def on_connect():
-            _LOGGER.info('I\'m connected!')
-            await sio.emit('auth', {'name': name, 'auth': auth})
+        # changes not yet saved
+        self._changed_device_ids = set()
+        self._devices_changed = False
+
+    @callback
+    def mark_changed(self, device_ids):
+        # the status of these devices changed (or the devices have been removed)
+        self._changed_device_ids.update(device_ids)
 
-        @sio.on('message')
-        async def on_message(data):
-            _LOGGER.info('I received a message!')
-            _LOGGER.info(str(data))
+    @callback
+    def mark_devices_changed(self):
+        # the device list changed
+        self._devices_changed = True
+
+    @callback
+    def discard(self):
+        # the loaded snapshot is not usable (e.g. another account): rewrite the base file at the next save
+        self._has_base = False
+        self._journal_records = 0
+        self._devices_changed = True
+
+    async def async_load(self):
+        # {'username', 'devices', 'devices_status'}, None if missing or unreadable
+        return await self._hass.async_add_executor_job(self._load)
+
+    def _load(self):
+        try:
+            with open(self._path, 'rb') as file:
+                if file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                    return None
+                snapshot = marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            _LOGGER.debug('_load() >>> no snapshot: ' + str(e))
+            return None
+        self._has_base = True
+        self._generation = snapshot['generation']
+        # replay the journal records of the same generation
+        try:
+            with open(self._journal_path, 'rb') as file:
+                journal = file.read()
+        except OSError:
+            journal = b''
+        offset = 0
+        while offset + 4 <= len(journal):
+            size = int.from_bytes(journal[offset:offset + 4], 'little')
+            if offset + 4 + size > len(journal):
+                # interrupted write
+                break
+            try:
+                record = marshal.loads(journal[offset + 4:offset + 4 + size])
+            except (EOFError, ValueError, TypeError):
+                break
+            offset += 4 + size
+            if record['generation'] != self._generation:
+                continue
+            self._journal_records += 1
+            if record['devices'] is not None:
+                snapshot['devices'] = record['devices']
+            for device_id, device_status in record['devices_status'].items():
+                if device_status is None:
+                    snapshot['devices_status'].pop(device_id, None)
+                else:
+                    snapshot['devices_status'][device_id] = device_status
+        return snapshot
+
+    async def async_save(self, now=None):
+        # save the changes: appended to the journal, or compacted into the base file
+        if not self._changed_device_ids and not self._devices_changed:
+            return False
+        async with self._lock:
+            platform = self._platform
+            compact = not self._has_base or self._journal_records >= SNAPSHOT_MAX_JOURNAL_RECORDS
+            generation = self._generation + 1
+            try:
+                # serialize here (the dicts are only modified in the event loop), write in the executor
+                if compact:
+                    payload = marshal.dumps({'generation': generation,
+                                             'username': platform.username,
+                                             'devices': platform.devices,
+                                             'devices_status': platform.devices_status})
+                else:
+                    payload = marshal.dumps({'generation': self._generation,
+                                             'devices': platform.devices if self._devices_changed else None,
+                                             'devices_status': {device_id: platform.devices_status.get(device_id)
+                                                                for device_id in self._changed_device_ids}})
+                self._changed_device_ids = set()
+                self._devices_changed = False
+                if compact:
+                    await self._hass.async_add_executor_job(self._write_base, payload)
+                    self._generation = generation
+                    self._journal_records = 0
+                    self._has_base = True
+                else:
+                    await self._hass.async_add_executor_job(self._append_journal, payload)
+                    self._journal_records += 1
+            except (OSError, ValueError) as e:
+                # not writable, or not serializable (e.g. an unexpected value type in a device status)
+                _LOGGER.error('Saving the Shelly Cloud snapshot failed: ' + str(e))
+                # write everything next time
+                self._changed_device_ids = set()
+                self._has_base = False
+                self._devices_changed = True
+                return False
+        return True
 
-        @sio.on('my message')
-        async def on_message(data):
-            _LOGGER.info('I received a custom message!')
-            _LOGGER.info(str(data))
+    def _write_base(self, payload):
+        # atomic: write a temporary file, then replace the base file
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(SNAPSHOT_MAGIC)
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self._path)
+        # the journal records belong to the previous generation
+        with open(self._journal_path, 'wb'):
+            pass
+
+    def _append_journal(self, payload):
+        with open(self._journal_path, 'ab') as file:
+            file.write(len(payload).to_bytes(4, 'little'))
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# SHELLY CLOUD COMMAND QUEUE
+# - coalesces the pending commands per (device, channel): the last write wins
+# - dispatches them concurrently, up to a bounded parallelism
+#
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class ShellyCloudCommandQueue:
+
+    def __init__(self, hass, async_send, max_parallel, metrics):
+
+        # home assistant
+        self._hass = hass
+        self._metrics = metrics
+
+        # coroutine sending a single command: async_send(device_id, channel, turn) -> True / False
+        self._async_send = async_send
+        self._semaphore = asyncio.Semaphore(max_parallel)
+
+        # (device id, channel) -> [turn, future], not yet dispatched
+        self._pending = collections.OrderedDict()
+        # (device id, channel) being dispatched
+        self._in_flight = set()
+        self._flush_scheduled = False
+
+    @callback
+    def async_submit(self, device_id, channel, turn):
+        # queue the command, returning a future resolved with the turn sent (None if it failed)
+        key = (device_id, channel)
+        pending = self._pending.get(key)
+        if pending is not None:
+            # not yet dispatched: replace it
+            pending[0] = turn
+            return pending[1]
+        future = self._hass.loop.create_future()
+        self._pending[key] = [turn, future]
+        self._schedule_flush()
+        return future
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._hass.loop.call_later(COMMAND_BATCH_DELAY, self._flush)
+
+    @callback
+    def _flush(self):
+        self._flush_scheduled = False
+        for key in list(self._pending):
+            # keep the order of commands on the same channel
+            if key in self._in_flight:
+                continue
+            turn, future = self._pending.pop(key)
+            self._in_flight.add(key)
+            self._hass.async_create_task(self._async_dispatch(key, turn, future))
+
+    async def _async_dispatch(self, key, turn, future):
+        device_id, channel = key
+        result = False
+        try:
+            async with self._semaphore:
+                start = time.monotonic()
+                result = await self._async_send(device_id, channel, turn)
+                self._metrics.record_command(time.monotonic() - start, result)
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception('Sending ' + turn + ' to ' + str(device_id) + ' channel ' + str(channel) + ' failed')
+        finally:
+            self._in_flight.discard(key)
+            if not future.done():
+                future.set_result(turn if result else None)
+            # a newer command for the same channel was waiting
+            if key in self._pending:
+                self._schedule_flush()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# SHELLY CLOUD STATE STORE
+# - relay states, availability and sensor raw values in typed columns (array), one stable slot per value
+# - the entities read their slot in O(1), the polls write the values of each device and get the changed keys
+#
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class ShellyCloudColumn:
+
+    def __init__(self, typecode, unknown):
+
+        # values, unknown until written
+        self.data = array.array(typecode)
+        self._unknown = unknown
+
+        # (device id, key) -> slot, device id -> keys, slots of the removed devices (reused)
+        self._slots = {}
+        self._device_keys = {}
+        self._free_slots = []
+
+    def slot(self, device_id, key=None):
+        # the slot of the value (allocated on first use, then stable until the device is removed)
+        slot = self._slots.get((device_id, key))
+        if slot is None:
+            if self._free_slots:
+                slot = self._free_slots.pop()
+            else:
+                slot = len(self.data)
+                self.data.append(self._unknown)
+            self._slots[(device_id, key)] = slot
+            self._device_keys.setdefault(device_id, []).append(key)
+        return slot
+
+    def read(self, device_id, key=None):
+        # the value (unknown if never written), without allocating a slot
+        slot = self._slots.get((device_id, key))
+        if slot is None:
+            return self._unknown
+        return self.data[slot]
+
+    def remove_device(self, device_id):
+        # free the slots of the device
+        for key in self._device_keys.pop(device_id, ()):
+            slot = self._slots.pop((device_id, key))
+            self.data[slot] = self._unknown
+            self._free_slots.append(slot)
+
+
+class ShellyCloudStateStore:
+
+    def __init__(self):
+
+        # relays: (device id, channel), 1 on / 0 off / -1 unknown
+        self.relays = ShellyCloudColumn('b', -1)
+        # cloud availability (connected and enabled): device id, 1 / 0 / -1 unknown
+        self.available = ShellyCloudColumn('b', -1)
+        # sensor raw values: (device id, sensor slot), NaN if unknown
+        self.values = ShellyCloudColumn('d', math.nan)
+
+        # write plan of each device, resolved once: device id -> (sensor extractor, relay slots, availability slot,
+        # [(sensor slot, status path, value slot)])
+        self._device_plans = {}
+
+    def _get_device_plan(self, device_id, device_status, extractor):
+        # the cached plan, rebuilt if the extractor or the number of relays changed
+        relays = device_status.get('relays', ())
+        plan = self._device_plans.get(device_id)
+        if plan is None or plan[0] is not extractor or len(plan[1]) != len(relays):
+            plan = (extractor,
+                    [self.relays.slot(device_id, channel) for channel in range(len(relays))],
+                    self.available.slot(device_id),
+                    [(slot, path, self.values.slot(device_id, slot)) for slot, path in extractor.paths])
+            self._device_plans[device_id] = plan
+        return plan
+
+    def write_device(self, device_id, device_status, extractor):
+        # write the values of a device in its slots, returning the changed keys ('relays', 'cloud', sensor slots)
+        changed_keys = set()
+        _, relay_slots, available_slot, value_slots = self._get_device_plan(device_id, device_status, extractor)
+        relays_data = self.relays.data
+        for slot, relay in zip(relay_slots, device_status.get('relays', ())):
+            ison = relay.get('ison')
+            value = -1 if ison is None else int(bool(ison))
+            if relays_data[slot] != value:
+                relays_data[slot] = value
+                changed_keys.add('relays')
+        cloud = device_status.get('cloud')
+        if cloud is not None:
+            value = int(bool(cloud.get('connected') and cloud.get('enabled')))
+            if self.available.data[available_slot] != value:
+                self.available.data[available_slot] = value
+                changed_keys.add('cloud')
+        values_data = self.values.data
+        for key, path, slot in value_slots:
+            try:
+                value = get_status_value(device_status, path)
+            except (KeyError, IndexError, TypeError):
+                continue
+            value = float(value) if isinstance(value, (int, float)) else math.nan
+            old_value = values_data[slot]
+            # NaN (unknown float) is not equal to itself
+            if old_value == value or (old_value != old_value and value != value):
+                continue
+            values_data[slot] = value
+            changed_keys.add(key)
+        return changed_keys
+
+    def get_sensor_values(self, device_id):
+        # sensor slot -> raw value (the known ones), as last written
+        plan = self._device_plans.get(device_id)
+        if plan is None:
+            return {}
+        values_data = self.values.data
+        return {key: values_data[slot] for key, _, slot in plan[3] if values_data[slot] == values_data[slot]}
+
+    def remove_device(self, device_id):
+        self._device_plans.pop(device_id, None)
+        self.relays.remove_device(device_id)
+        self.available.remove_device(device_id)
+        self.values.remove_device(device_id)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# SHELLY CLOUD AGGREGATOR
+# - every sample of the power, current and voltage sensors goes into bounded per-minute buckets (min, max, area)
+# - the power (W) is integrated into energy (kWh), with the trapezoidal rule
+# - min / max / time-weighted mean over the windows and downsampled series are computed from the buckets
+#
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class ShellyCloudAggregate:
+
+    def __init__(self, max_buckets, integrate):
+
+        # ring buffer of the buckets: [start, min, max, area (value x seconds), duration (seconds)]
+        self.buckets = collections.deque(maxlen=max_buckets)
+        # last sample (time, value)
+        self.last = None
+        # integrated energy (kWh), None if not a power
+        self.energy = 0.0 if integrate else None
+
+    def _bucket(self, timestamp):
+        start = timestamp - timestamp % AGGREGATION_BUCKET.total_seconds()
+        if not self.buckets or self.buckets[-1][0] != start:
+            self.buckets.append([start, math.inf, -math.inf, 0.0, 0.0])
+        return self.buckets[-1]
+
+    def add(self, timestamp, value):
+        bucket = self._bucket(timestamp)
+        if self.last is not None:
+            last_timestamp, last_value = self.last
+            duration = timestamp - last_timestamp
+            if 0 < duration <= AGGREGATION_MAX_GAP.total_seconds():
+                area = (last_value + value) / 2 * duration
+                bucket[3] += area
+                bucket[4] += duration
+                if self.energy is not None:
+                    # W x s -> kWh
+                    self.energy += area / 3600000
+        bucket[1] = min(bucket[1], value)
+        bucket[2] = max(bucket[2], value)
+        self.last = (timestamp, value)
+
+    def stats(self, window, now):
+        # (min, max, mean) over the window, None if no samples
+        since = now - window
+        minimum, maximum, area, duration = math.inf, -math.inf, 0.0, 0.0
+        for start, bucket_min, bucket_max, bucket_area, bucket_duration in reversed(self.buckets):
+            if start + AGGREGATION_BUCKET.total_seconds() <= since:
+                break
+            minimum = min(minimum, bucket_min)
+            maximum = max(maximum, bucket_max)
+            area += bucket_area
+            duration += bucket_duration
+        if minimum == math.inf:
+            return None
+        mean = area / duration if duration else self.last[1]
+        return minimum, maximum, mean
+
+    def series(self, window, now, points=AGGREGATION_SERIES_POINTS):
+        # [(start, mean)] of the window, downsampled to points time-weighted means
+        step = window / points
+        since = now - window
+        groups = collections.OrderedDict()
+        for start, _, _, area, duration in self.buckets:
+            if start + AGGREGATION_BUCKET.total_seconds() <= since or not duration:
+                continue
+            group = groups.setdefault(max(int((start - since) // step), 0), [0.0, 0.0])
+            group[0] += area
+            group[1] += duration
+        return [(since + index * step, area / duration) for index, (area, duration) in groups.items()]
+
+
+class ShellyCloudAggregator:
+
+    def __init__(self, windows):
+
+        # windows (seconds), the buckets kept cover the longest one
+        self.windows = [window.total_seconds() for window in windows]
+        self._max_buckets = int(math.ceil(max(self.windows) / AGGREGATION_BUCKET.total_seconds())) + 1
+
+        # (device id, sensor slot) -> ShellyCloudAggregate
+        self._aggregates = {}
+
+    def add_samples(self, device_id, sensor_values, timestamp):
+        # add the (scaled) values of the aggregated sensors of a device
+        for slot, value in sensor_values.items():
+            if slot[0] not in AGGREGATED_SENSORS or not isinstance(value, (int, float)):
+                continue
+            descriptor = shelly_cloud_SENSORS_MAP[slot[0]]
+            aggregate = self._aggregates.get((device_id, slot))
+            if aggregate is None:
+                aggregate = ShellyCloudAggregate(self._max_buckets, descriptor.uom == 'W')
+                self._aggregates[(device_id, slot)] = aggregate
+            aggregate.add(timestamp, value * descriptor.factor)
+
+    def get_aggregate(self, device_id, slot):
+        return self._aggregates.get((device_id, slot))
+
+    def restore_energy(self, device_id, slot, energy):
+        # continue the integrated energy from its last known value (e.g. restored at startup)
+        aggregate = self._aggregates.get((device_id, slot))
+        if aggregate is None:
+            aggregate = ShellyCloudAggregate(self._max_buckets, True)
+            self._aggregates[(device_id, slot)] = aggregate
+        aggregate.energy = energy + (aggregate.energy or 0)
+
+    def remove_device(self, device_id):
+        for key in [key for key in self._aggregates if key[0] == device_id]:
+            del self._aggregates[key]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# SHELLY CLOUD SCHEDULER
+# - a single timer runs the periodic jobs of all the accounts
+# - the jobs of the same kind are staggered across their interval, with jitter, so that the accounts do not poll
+#   all at once
+#
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class ShellyCloudScheduler:
+
+    def __init__(self, hass):
+
+        # home assistant
+        self._hass = hass
+
+        # kind -> jobs {'interval', 'action', 'next', 'running'}, in order of registration
+        self._jobs = collections.OrderedDict()
+        self._unsub_tick = None
+
+    @callback
+    def add_job(self, kind, interval, action):
+        # action(now) is a coroutine, run every interval (a timedelta) and never overlapping itself
+        job = {'interval': interval.total_seconds(), 'action': action, 'next': 0, 'running': False}
+        jobs = self._jobs.setdefault(kind, [])
+        jobs.append(job)
+        self._stagger(jobs)
+        if self._unsub_tick is None:
+            self._unsub_tick = async_track_time_interval(self._hass, self._tick, SCHEDULER_TICK)
+        return job
+
+    @staticmethod
+    def _stagger(jobs):
+        # spread the jobs over their interval, keeping the phase of the earliest one already scheduled
+        now = time.monotonic()
+        scheduled = [job['next'] for job in jobs if job['next']]
+        anchor = min(scheduled) if scheduled else now + jobs[0]['interval']
+        for index, job in enumerate(jobs):
+            job['next'] = anchor + job['interval'] * index / len(jobs)
+
+    @callback
+    def _tick(self, now):
+        monotonic = time.monotonic()
+        for jobs in self._jobs.values():
+            for job in jobs:
+                if job['running'] or job['next'] > monotonic:
+                    continue
+                # skip the missed runs instead of bursting them
+                while job['next'] <= monotonic:
+                    job['next'] += job['interval']
+                # jitter, so that the staggered jobs do not drift back together
+                job['next'] += random.uniform(-SCHEDULER_JITTER, SCHEDULER_JITTER) * job['interval']
+                job['running'] = True
+                self._hass.async_create_task(self._async_run(job, now))
+
+    async def _async_run(self, job, now):
+        try:
+            await job['action'](now)
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception('Shelly Cloud scheduled job failed')
+        finally:
+            job['running'] = False
 
-        @sio.on('disconnect')
-        async def on_disconnect():
-            _LOGGER.info('I\'m disconnected!')
 
 # ----------------------------------------------------------------------------------------------------------------------
 #
@@ -151,112 +1511,601 @@ async def async_socketio(hass, config):
 
 class ShellyCloudPlatform:
 
-    def __init__(self, hass, config):
+    def __init__(self, hass, config, account_config, scheduler):
 
         # home assistant
         self._hass = hass
         self._config = config
+        self._scheduler = scheduler
+
+        # account namespace of the entity ids, signals and storage files (the legacy ones for an account without name)
+        self.name = account_config.get(CONF_NAME)
+        self.namespace = DOMAIN if self.name is None else DOMAIN + '_' + self.name
 
         # scan intervals
-        self.update_devices_status_interval = config[DOMAIN][CONF_SCAN_INTERVAL]
-        self.discover_devices_interval = config[DOMAIN][CONF_SHELLY_CLOUD_DEVICES_SCAN_INTERVAL]
+        self.update_devices_status_interval = account_config[CONF_SCAN_INTERVAL]
+        self.discover_devices_interval = account_config[CONF_SHELLY_CLOUD_DEVICES_SCAN_INTERVAL]
+        self.notifications_scan_interval = account_config[CONF_NOTIFICATIONS_SCAN_INTERVAL]
+        self.priority_scan_interval = account_config[CONF_PRIORITY_SCAN_INTERVAL]
+        self.idle_scan_interval = account_config[CONF_IDLE_SCAN_INTERVAL]
 
         # Shelly Cloud credentials
-        self.username = config[DOMAIN][CONF_USERNAME]
-        self._password = config[DOMAIN][CONF_PASSWORD]
+        self.username = account_config[CONF_USERNAME]
+        self._password = account_config[CONF_PASSWORD]
 
-        # do login and get data (False otherwise...)
+        # HTTP transport: HA shared aiohttp session (keep-alive connection pool)
+        self._session = async_get_clientsession(hass)
+        self._request_timeout = aiohttp.ClientTimeout(total=account_config[CONF_REQUEST_TIMEOUT].total_seconds())
+        self._api_url = account_config[CONF_API_URL].rstrip('/')
+
+        # login data (False otherwise...)
         self.auth = None
         self._user_api_url = None
-        self._data = self.login()
-        if self._data:
-            self._user_api_url = self._data['user_api_url']
-            self.auth = self._data['token']
-            # start websocket
-            # hass.async_create_task(async_socketio(hass, config))
-
-        # if we have data, get device list and status
+        # endpoint used for the commands (the user api, or the fastest advertised host if probed)
+        self._control_api_url = None
+        self._probe_endpoints = account_config[CONF_PROBE_ENDPOINTS]
+        self._data = False
+        self._token_expires = 0
+        self._auth_store = Store(hass, STORAGE_VERSION, STORAGE_KEY_AUTH.format(self.namespace))
+        self._login_lock = asyncio.Lock()
+        self._unsub_token_refresh = None
+        # failed logins: next attempt (monotonic) and current backoff (seconds)
+        self._login_retry_at = 0
+        self._login_backoff = LOGIN_MIN_BACKOFF
+
+        # device list and status
         self.devices = {}
         self.devices_status = {}
-        if self._data:
-            self.devices = self.get_device_list()
-            if self.devices:
-                self.devices_status = self.get_devices_status()
+        self._last_devices_status_update = 0
+
+        # relay states, availability and sensor values read by the entities, used to detect changes
+        self.state = ShellyCloudStateStore()
+
+        # per-device polling: when (monotonic) each device is due, when it last changed, the high priority ones
+        self._device_next_poll = {}
+        self._device_last_change = {}
+        self._priority_device_ids = set(account_config[CONF_PRIORITY_DEVICES])
+        # the poll job runs at the fastest device interval, devices due within half of it are polled in advance
+        self._poll_interval = min(self.priority_scan_interval, self.update_devices_status_interval)
+        self._poll_tolerance = self._poll_interval.total_seconds() / 2
+
+        # sensors: extractor of each device shape, extractor of each device (the shape resolved once)
+        self._sensor_extractors = {}
+        self._device_extractors = {}
+
+        # publish filters of the sensor values, by sensor type
+        self.sensor_filters = {}
+        for sensor_type, sensor_filter in account_config[CONF_SENSOR_FILTERS].items():
+            min_interval = sensor_filter.get(CONF_MIN_INTERVAL)
+            max_interval = sensor_filter.get(CONF_MAX_INTERVAL)
+            self.sensor_filters[sensor_type] = ShellyCloudSensorFilter(
+                sensor_filter[CONF_DEADBAND],
+                sensor_filter[CONF_RELATIVE_DEADBAND],
+                min_interval.total_seconds() if min_interval is not None else None,
+                max_interval.total_seconds() if max_interval is not None else None)
+
+        # rolling aggregates of the power, current and voltage sensors (None if disabled)
+        self.aggregator = None
+        if account_config[CONF_AGGREGATION]:
+            self.aggregator = ShellyCloudAggregator(account_config[CONF_AGGREGATION_WINDOWS])
+
+        # registered entity ids of each device
+        self.entities = {}
+
+        # switch commands not yet confirmed: (device id, channel) -> {'ison', 'token', 'started'}
+        self.pending_commands = {}
+        self._command_tokens = itertools.count()
+
+        # entity debug traces sampling (read by the entities of the account)
+        self.trace_sample_rate = account_config[CONF_TRACE_SAMPLE_RATE]
+
+        # metrics
+        self.metrics = ShellyCloudMetrics()
+        self._diagnostics = account_config[CONF_DIAGNOSTICS]
+
+        # requests rate limiter
+        self.rate_limiter = ShellyCloudRateLimiter(hass,
+                                                   account_config[CONF_RATE_LIMIT],
+                                                   account_config[CONF_RATE_LIMIT_BURST])
+
+        # local (LAN) transport (None if disabled)
+        self.local = None
+        if account_config[CONF_LOCAL_POLLING]:
+            self.local = ShellyLocalTransport(self._session, self.metrics)
+
+        # relay commands queue
+        self.commands = ShellyCloudCommandQueue(hass,
+                                                self.async_send_device_channel,
+                                                account_config[CONF_MAX_PARALLEL_COMMANDS],
+                                                self.metrics)
+
+        # local snapshot of the devices and their status
+        self._snapshot = ShellyCloudSnapshot(hass, self)
+
+        # push notifications channel (None if disabled)
+        self._notifications_started = False
+        self.notifications = None
+        if account_config[CONF_NOTIFICATIONS]:
+            self.notifications = ShellyCloudNotifications(hass, self)
+
+        # discovered device ids
+        self._discovered_switches_device_ids = set()
+        self._discovered_sensors_device_ids = set()
+
+    async def async_restore(self):
+
+        # restore the devices and their last known status from the local snapshot
+        snapshot = await self._snapshot.async_load()
+        if snapshot and snapshot.get('username') == self.username:
+            _LOGGER.info('Restoring ' + str(len(snapshot['devices'])) + ' Shelly Cloud device(s) from the snapshot')
+            self.devices = snapshot['devices']
+            self.devices_status = {device_id: prune_device_status(device_status)
+                                   for device_id, device_status in snapshot['devices_status'].items()}
+            if self.local is not None:
+                self.local.update_addresses(self.devices)
+            # last known values, not samples of the aggregates
+            for device_id in self.devices_status:
+                self.update_device_state(device_id)
+        elif snapshot:
+            # saved by another account: not journaled on, rewritten
+            _LOGGER.info('Ignoring the snapshot of another Shelly Cloud account')
+            self._snapshot.discard()
 
         # switch discovery
-        self._discovered_switches_device_ids = []
         self.discover_switches()
 
         # sensor discovery
-        self._discovered_sensors_device_ids = []
         self.discover_sensors()
 
+        # diagnostic sensors
+        if self._diagnostics:
+            self._hass.async_create_task(
+                discovery.async_load_platform(self._hass,
+                                              HA_SENSOR,
+                                              DOMAIN,
+                                              {'shelly_cloud_diagnostics': True,
+                                               'shelly_cloud_account': self.namespace},
+                                              self._config))
+
+        return True
+
+    async def async_start(self):
+
+        # reuse the stored token, do login otherwise (False if it fails...)
+        await self.async_authenticate()
+
+        # if we have data, get device list and status, then reconcile with the restored ones
+        if self._data:
+            devices = await self.async_get_device_list()
+            if isinstance(devices, dict):
+                devices_status = await self.async_get_devices_status()
+                if devices_status:
+                    self._last_devices_status_update = time.monotonic()
+                    self.apply_devices_status(devices_status)
+                await self.async_reconcile_devices(devices)
+
         # starting timers
-        hass.async_create_task(self.async_start_timer())
+        self._hass.async_create_task(self.async_start_timer())
+
+        # start websocket
+        self.start_notifications()
+
+        return True
+
+    def start_notifications(self):
+        # start the websocket (once, as soon as we are logged in)
+        if self._data and self.notifications is not None and not self._notifications_started:
+            self._notifications_started = True
+            self._hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, self.notifications.async_stop)
+            self.notifications.start()
 
     async def async_start_timer(self):
 
+        # the jobs are run by the shared scheduler, staggered with the ones of the other accounts
+
         # This is used to update the Meross Devices status periodically
-        _LOGGER.info('Shelly Cloud devices status will be updated each ' + str(self.update_devices_status_interval))
-        async_track_time_interval(self._hass,
-                                  self.async_update_devices,
-                                  self.update_devices_status_interval)
+        _LOGGER.info('Shelly Cloud (' + self.username + ') devices status will be updated each ' +
+                     str(self.update_devices_status_interval))
+        self._scheduler.add_job(JOB_UPDATE_DEVICES,
+                                self._poll_interval,
+                                self.async_update_devices)
 
         # This is used to discover new Meross Devices periodically
-        _LOGGER.info('Shelly Cloud devices list will be updated each ' + str(self.discover_devices_interval))
-        async_track_time_interval(self._hass,
-                                  self.async_discover_devices,
-                                  self.discover_devices_interval)
+        _LOGGER.info('Shelly Cloud (' + self.username + ') devices list will be updated each ' +
+                     str(self.discover_devices_interval))
+        self._scheduler.add_job(JOB_DISCOVER_DEVICES,
+                                self.discover_devices_interval,
+                                self.async_discover_devices)
+
+        # This is used to save the changed devices in the local snapshot periodically (and at HA stop)
+        self._scheduler.add_job(JOB_SAVE_SNAPSHOT,
+                                SNAPSHOT_SAVE_INTERVAL,
+                                self._snapshot.async_save)
+
+        # This is used to refresh the aggregate sensors periodically (their value changes even if the devices do not)
+        if self.aggregator is not None:
+            self._scheduler.add_job(JOB_PUBLISH_AGGREGATES,
+                                    AGGREGATION_PUBLISH_INTERVAL,
+                                    self.async_publish_aggregates)
+        self._hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, self._snapshot.async_save)
+
+        return True
 
+    async def async_publish_aggregates(self, now=None):
+        async_dispatcher_send(self._hass, SIGNAL_UPDATE_AGGREGATES.format(self.namespace))
         return True
 
     async def async_update_devices(self, now=None):
 
-        # monitor the duration in millis
-        # registering starting timestamp in ms
-        start_ms = int(round(time.time() * 1000))
+        # monitor the duration
+        start = time.monotonic()
+        changed_devices = {}
 
         _LOGGER.debug('async_update_devices() >>> STARTED at ' + str(now))
 
-        self.devices_status = self.get_devices_status()
+        # the devices due for a poll (all of them until the device list is known)
+        due_device_ids = None
+        if self.devices:
+            due_device_ids = self.get_due_device_ids(start)
+            if not due_device_ids:
+                _LOGGER.debug('async_update_devices() >>> no device due')
+                return True
+
+        # poll the devices on the LAN first
+        local_devices_status = {}
+        if self.local is not None:
+            local_devices_status = await self.local.async_get_devices_status(due_device_ids)
+
+        # the Shelly Cloud is needed only for the devices not reachable on the LAN
+        cloud_device_ids = due_device_ids
+        if self.local is not None and due_device_ids is not None:
+            cloud_device_ids = [device_id for device_id in due_device_ids if not self.local.is_reachable(device_id)]
+        cloud_needed = cloud_device_ids is None or len(cloud_device_ids) > 0
+
+        # while the notifications channel delivers device changes, polling is only a safety net
+        if cloud_needed and self.notifications is not None and self.notifications.live:
+            elapsed = time.monotonic() - self._last_devices_status_update
+            if elapsed < self.notifications_scan_interval.total_seconds():
+                _LOGGER.debug('async_update_devices() >>> cloud poll SKIPPED (notifications channel live)')
+                cloud_needed = False
+
+        # the startup could not login: try again
+        if cloud_needed and not self._data:
+            cloud_needed = await self.async_relogin()
+            self.start_notifications()
+
+        devices_status = None
+        polled_device_ids = list(local_devices_status)
+        # the devices with a new status (None: all of them)
+        received_device_ids = set(local_devices_status)
+        if cloud_needed and cloud_device_ids is not None and len(cloud_device_ids) <= DEVICE_STATUS_MAX_REQUESTS:
+            # few devices due: one request each
+            cloud_devices_status = await self.async_get_device_status_batch(cloud_device_ids)
+            if cloud_devices_status:
+                devices_status = dict(self.devices_status)
+                devices_status.update(cloud_devices_status)
+                received_device_ids.update(cloud_devices_status)
+            polled_device_ids.extend(cloud_device_ids)
+        elif cloud_needed:
+            # many devices due: a single request for all of them
+            devices_status = await self.async_get_devices_status()
+            if devices_status:
+                self._last_devices_status_update = time.monotonic()
+                received_device_ids = None
+                # every device has been refreshed: poll them together again
+                polled_device_ids = list(self.devices)
+            elif due_device_ids is not None:
+                polled_device_ids = due_device_ids
+        elif due_device_ids is not None:
+            polled_device_ids = due_device_ids
+        if local_devices_status:
+            if not devices_status:
+                devices_status = dict(self.devices_status)
+            devices_status.update(local_devices_status)
+
+        if devices_status:
+            changed_devices = self.apply_devices_status(devices_status, received_device_ids)
+            _LOGGER.debug('async_update_devices() >>> ' + str(len(changed_devices)) + ' device(s) changed')
+
+        # next poll of each polled device, at its own interval
+        self.schedule_devices_poll(polled_device_ids, time.monotonic())
 
         _LOGGER.debug('async_update_devices() <<< TERMINATED')
 
-        # registering ending timestamp in ms
-        end_ms = int(round(time.time() * 1000))
-        duration_ms = end_ms - start_ms
-        duration_s = int(round(duration_ms / 1000))
-        duration_td = datetime.timedelta(seconds=duration_s)
-        if duration_td > self.update_devices_status_interval:
-            _LOGGER.warning('Updating the Shelly Cloud devices status took ' + str(duration_td))
+        duration = time.monotonic() - start
+        self.metrics.record_poll(duration, len(changed_devices))
+        async_dispatcher_send(self._hass, SIGNAL_UPDATE_METRICS.format(self.namespace))
+        if duration > self.update_devices_status_interval.total_seconds():
+            _LOGGER.warning('Updating the Shelly Cloud devices status took ' + str(timedelta(seconds=duration)))
 
         return True
 
+    @callback
+    def apply_devices_status(self, devices_status, device_ids=None):
+        # replace the devices status, waking up only the entities of the changed devices
+        # device_ids: the devices with a new status (all if None), the others are not written again
+        self.devices_status = devices_status
+        changed_devices = self.update_devices_state(device_ids)
+        for device_id, changed_keys in changed_devices.items():
+            async_dispatcher_send(self._hass, SIGNAL_UPDATE_ENTITY.format(self.namespace, device_id), changed_keys)
+        self._snapshot.mark_changed(changed_devices)
+        self.mark_devices_active(changed_devices)
+        # devices listed before their status was known (e.g. a failed first poll): discover them now
+        self.discover_new_devices()
+        return changed_devices
+
+    def get_device_scan_interval(self, device_id, now):
+        # priority and recently changed devices are polled faster, offline and idle ones slower (seconds)
+        last_change = self._device_last_change.get(device_id, now - DEVICE_ACTIVE_PERIOD.total_seconds())
+        if device_id in self._priority_device_ids or now - last_change < DEVICE_ACTIVE_PERIOD.total_seconds():
+            return self.priority_scan_interval.total_seconds()
+        if device_id not in self.devices_status:
+            return self.update_devices_status_interval.total_seconds()
+        if now - last_change >= DEVICE_IDLE_PERIOD.total_seconds() or not self.get_device_availability(device_id):
+            return self.idle_scan_interval.total_seconds()
+        return self.update_devices_status_interval.total_seconds()
+
+    def get_due_device_ids(self, now):
+        # the devices due for a poll (or soon due, to poll them together)
+        due = now + self._poll_tolerance
+        return [device_id for device_id in self.devices if self._device_next_poll.get(device_id, 0) <= due]
+
+    def schedule_devices_poll(self, device_ids, now):
+        for device_id in device_ids:
+            interval = self.get_device_scan_interval(device_id, now)
+            self._device_next_poll[device_id] = now + interval * (1 + random.uniform(0, SCHEDULER_JITTER))
+
+    @callback
+    def mark_devices_active(self, device_ids):
+        # a changed device is polled faster for a while
+        now = time.monotonic()
+        for device_id in device_ids:
+            if device_id not in self._device_last_change:
+                # first status: neither active nor idle
+                self._device_last_change[device_id] = now - DEVICE_ACTIVE_PERIOD.total_seconds()
+                continue
+            self._device_last_change[device_id] = now
+            next_poll = now + self.priority_scan_interval.total_seconds()
+            if self._device_next_poll.get(device_id, 0) > next_poll:
+                self._device_next_poll[device_id] = next_poll
+
     async def async_discover_devices(self, now=None):
 
         _LOGGER.debug('async_discover_plugs >>> STARTED at ' + str(now))
 
+        # the startup could not login: try again
+        if not self._data:
+            if not await self.async_relogin():
+                return False
+            self.start_notifications()
+
         # get all the registered devices
-        self.devices = self.get_device_list()
-        self.discover_switches()
+        devices = await self.async_get_device_list()
+        if isinstance(devices, dict):
+            await self.async_reconcile_devices(devices)
 
         _LOGGER.debug('async_discover_plugs <<< FINISHED')
 
         return True
 
-    def login(self):
+    async def async_reconcile_devices(self, devices):
+        # apply the differences between the known and the new device list
+        old_devices = self.devices
+        self.devices = devices
+        if self.local is not None:
+            self.local.update_addresses(self.devices)
+
+        # removed devices: remove their entities and forget them
+        for device_id in old_devices.keys() - devices.keys():
+            _LOGGER.info('device id ' + str(device_id) + ' removed from the Shelly Cloud account')
+            self.remove_device_entities(device_id)
+            self._discovered_switches_device_ids.discard(device_id)
+            self._discovered_sensors_device_ids.discard(device_id)
+            self.devices_status.pop(device_id, None)
+            self._device_extractors.pop(device_id, None)
+            self.state.remove_device(device_id)
+            if self.aggregator is not None:
+                self.aggregator.remove_device(device_id)
+            self._device_next_poll.pop(device_id, None)
+            self._device_last_change.pop(device_id, None)
+            self._snapshot.mark_changed([device_id])
+
+        # renamed devices: let their entities pick the new name
+        for device_id in old_devices.keys() & devices.keys():
+            if old_devices[device_id].get('type') != devices[device_id].get('type'):
+                # a different model: its shape is resolved again
+                self._device_extractors.pop(device_id, None)
+            if old_devices[device_id].get('name') != devices[device_id].get('name'):
+                _LOGGER.info('device id ' + str(device_id) + ' renamed to ' + str(devices[device_id].get('name')))
+                async_dispatcher_send(self._hass, SIGNAL_UPDATE_ENTITY.format(self.namespace, device_id), {'name'})
+
+        # added devices: get their status, then discover their entities
+        added_device_ids = devices.keys() - old_devices.keys()
+        if added_device_ids:
+            _LOGGER.info(str(len(added_device_ids)) + ' device(s) added to the Shelly Cloud account')
+            if not added_device_ids <= self.devices_status.keys():
+                devices_status = await self.async_get_devices_status()
+                if devices_status:
+                    for device_id in added_device_ids & devices_status.keys():
+                        self.devices_status[device_id] = devices_status[device_id]
+                        self.update_device_state(device_id)
+                        self.add_device_samples(device_id)
+                        self._snapshot.mark_changed([device_id])
+
+        # discover the devices with a known status (the others once a poll gets it)
+        self.discover_new_devices()
+
+        if devices != old_devices:
+            self._snapshot.mark_devices_changed()
+
+        return True
+
+    async def async_authenticate(self):
+        # reuse the stored token if still valid, do login otherwise
+        stored = await self._auth_store.async_load()
+        if (stored and stored.get('username') == self.username and
+                stored.get('expires', 0) - time.time() > TOKEN_REFRESH_MARGIN.total_seconds()):
+            _LOGGER.info('Reusing the stored Shelly Cloud token')
+            self._set_login_data(stored['data'], stored['expires'])
+        else:
+            await self.async_relogin()
+        return self._data
+
+    async def async_relogin(self, expired_auth=None):
+        # do login (once, even if several requests ask for it at the same time)
+        async with self._login_lock:
+            if expired_auth is not None and self.auth != expired_auth:
+                # someone else already refreshed the token
+                return bool(self._data)
+            # the last login failed: wait for the backoff (e.g. wrong credentials, auth outage)
+            now = time.monotonic()
+            if now < self._login_retry_at:
+                _LOGGER.debug('async_relogin() >>> SKIPPED, next attempt in ' +
+                              str(round(self._login_retry_at - now)) + ' s')
+                return False
+            data = await self.async_login()
+            if not data:
+                self._login_retry_at = time.monotonic() + self._login_backoff
+                _LOGGER.warning('Shelly Cloud login failed, next attempt in ' + str(self._login_backoff) + ' s')
+                self._login_backoff = min(self._login_backoff * 2, LOGIN_MAX_BACKOFF)
+                return False
+            self._login_retry_at = 0
+            self._login_backoff = LOGIN_MIN_BACKOFF
+            self._set_login_data(data, get_token_expiry(data['token']))
+            await self._auth_store.async_save({'username': self.username,
+                                               'data': data,
+                                               'expires': self._token_expires})
+            return True
+
+    def _set_login_data(self, data, expires):
+        # keep the login data and schedule the token refresh before it expires
+        self._data = data
+        self._user_api_url = data['user_api_url'].rstrip('/')
+        self._control_api_url = self._user_api_url
+        self.auth = data['token']
+        self._token_expires = expires
+        if self._probe_endpoints:
+            self._hass.async_create_task(self.async_probe_endpoints())
+        if self._unsub_token_refresh is not None:
+            self._unsub_token_refresh()
+        delay = max(expires - time.time() - TOKEN_REFRESH_MARGIN.total_seconds(), 60)
+        _LOGGER.info('Shelly Cloud token will be refreshed in ' + str(timedelta(seconds=int(delay))))
+        self._unsub_token_refresh = async_call_later(self._hass, delay, self._async_refresh_token)
+
+    def get_advertised_api_urls(self):
+        # the user api url, plus the https hosts advertised for the notifications (same shard)
+        api_urls = [self._user_api_url]
+        for notifications_url in self.get_notifications_urls() or []:
+            parsed_url = urllib.parse.urlsplit(notifications_url)
+            if parsed_url.hostname:
+                api_url = 'https://' + parsed_url.hostname
+                if api_url not in api_urls:
+                    api_urls.append(api_url)
+        return api_urls
+
+    async def async_probe_endpoints(self):
+        # measure the latency of the advertised hosts, using the fastest one for the commands
+        latencies = {}
+        for api_url in self.get_advertised_api_urls():
+            # a host is valid only if it answers an authenticated API call (not just any HTTP response)
+            start = time.monotonic()
+            data = await self._async_request('POST', api_url + '/interface/device/list', retry=False)
+            if not isinstance(data, dict) or not data.get('isok'):
+                _LOGGER.debug('async_probe_endpoints() >>> ' + api_url + ' is not a valid Shelly Cloud API host')
+                continue
+            latencies[api_url] = time.monotonic() - start
+            _LOGGER.debug('async_probe_endpoints() >>> ' + api_url + ' ' +
+                          str(round(latencies[api_url] * 1000)) + ' ms')
+        if latencies:
+            self._control_api_url = min(latencies, key=latencies.get)
+            _LOGGER.info('Shelly Cloud commands will be sent to ' + self._control_api_url)
+        return latencies
+
+    async def _async_refresh_token(self, now=None):
+        # refresh the token in background
+        self._unsub_token_refresh = None
+        if not await self.async_relogin():
+            # retry later, the current token is still valid for a while
+            self._unsub_token_refresh = async_call_later(self._hass, 60, self._async_refresh_token)
+
+    async def _async_request(self, method, url, data=None, auth=True, retry=True, priority=PRIORITY_POLL,
+                             stream=None):
+        # wait for the rate limiter
+        await self.rate_limiter.async_acquire(priority)
+        # set the authorization header
+        headers = {}
+        auth_token = self.auth
+        if auth:
+            headers['Authorization'] = 'Bearer ' + str(auth_token)
+        # metrics are grouped by endpoint (url path)
+        endpoint = urllib.parse.urlsplit(url).path
+        try:
+            # send the request through the shared session
+            start = time.monotonic()
+            async with self._session.request(method,
+                                             url,
+                                             data=data,
+                                             headers=headers,
+                                             timeout=self._request_timeout) as response:
+                if response.status == 429 or response.status >= 500:
+                    self.metrics.record_error(endpoint, response.status)
+                    self.rate_limiter.report_throttled(response.headers.get('Retry-After'))
+                    _LOGGER.error(method + ' ' + url + ' failed: HTTP ' + str(response.status))
+                    return None
+                if response.status != 401 or not auth or not retry:
+                    # get dict of the response (the cloud does not always set the json content type)
+                    if stream is not None:
+                        # parsed while received: stream(response) -> (response data, size)
+                        response_data, size = await stream(response)
+                    else:
+                        body = await response.read()
+                        size = len(body)
+                        response_data = json.loads(body)
+                    self.metrics.record_request(endpoint, time.monotonic() - start, size)
+                    errors = response_data.get('errors') if isinstance(response_data, dict) else None
+                    if isinstance(errors, dict):
+                        for error in errors:
+                            self.metrics.record_error(endpoint, error)
+                    if isinstance(errors, dict) and any(error in errors for error in RATE_LIMIT_ERRORS):
+                        self.rate_limiter.report_throttled()
+                    else:
+                        self.rate_limiter.report_success()
+                    return response_data
+            # expired token: login again and retry once
+            self.metrics.record_error(endpoint, 401)
+            _LOGGER.info(method + ' ' + url + ' unauthorized, logging in again')
+            if await self.async_relogin(auth_token):
+                return await self._async_request(method, url, data, auth, retry=False, priority=priority, stream=stream)
+            return None
+        except asyncio.TimeoutError:
+            self.metrics.record_error(endpoint, 'timeout')
+            _LOGGER.error(method + ' ' + url + ' timed out')
+        except (aiohttp.ClientError, ValueError) as e:
+            self.metrics.record_error(endpoint, type(e).__name__)
+            _LOGGER.error(method + ' ' + url + ' failed: ' + str(e))
+        return None
+
+    @staticmethod
+    def _log_errors(data):
+        # print errors
+        errors = data.get('errors', {})
+        for error_title, error_message in errors.items():
+            _LOGGER.error(str(error_title) + ' : ' + str(error_message))
+
+    async def async_login(self):
         # login url
-        url = 'https://api.shelly.cloud/auth/login'
+        url = self._api_url + '/auth/login'
         # get e-mail
         email = self.username
         # get sha1 password
         sha1_password = hashlib.sha1(self._password.encode('utf-8')).hexdigest()
         # set POST https params
         params = {'email': email, 'password': sha1_password}
-        # get response to POST request
-        response = requests.post(url, params)
         # get dict of POST response
-        data = response.json()
+        data = await self._async_request('POST', url, params, auth=False, priority=PRIORITY_COMMAND)
+        if data is None:
+            _LOGGER.info('Login failed')
+            return False
         # check if everything is Ok
         if data['isok']:
             # login was succesful!
@@ -264,56 +2113,72 @@ class ShellyCloudPlatform:
             return data['data']
         else:
             _LOGGER.info('Login failed')
-            # print errors
-            errors = data['errors']
-            for error_title, error_message in errors.items():
-                _LOGGER.error(error_title + ' : ' + error_message)
+            self._log_errors(data)
         return False
 
-    def get_device_switch_status(self, device_id, channel):
-        # check if device is present in the list
-        if device_id in self.devices_status:
-            # get device status info
-            device_status_info = self.devices_status[device_id]
-            if 'relays' in device_status_info:
-                # check if the device channel is on
-                if channel < len(device_status_info['relays']):
-                    return device_status_info['relays'][channel]['ison']
-                else:
-                    _LOGGER.warning('get_device_switch_status() >>> channel ' +
-                                    str(channel) + ' in device id ' +
-                                    str(device_id) + ' not found')
-            else:
-                _LOGGER.warning('get_device_switch_status() >>> device id ' +
-                                str(device_id) + ' has no relays')
-        else:
-            _LOGGER.warning('get_device_switch_status() >>> device id ' +
-                            str(device_id) + ' not found')
-        # otherwise, return false
-        return False
+    @callback
+    def begin_command(self, device_id, channel, is_on):
+        # the optimistic state of the channel, until the command is confirmed
+        token = next(self._command_tokens)
+        self.pending_commands[(device_id, channel)] = {'ison': is_on, 'token': token, 'started': time.monotonic()}
+        self.mark_devices_active([device_id])
+        return token
 
-    def get_device_availability(self, device_id):
-        # check if device is present in the list
+    @callback
+    def end_command(self, device_id, channel, token, turn):
+        # confirm (turn sent) or roll back (turn None) the optimistic state
+        key = (device_id, channel)
+        if turn is not None:
+            relays = self.devices_status.get(device_id, {}).get('relays')
+            if relays is not None and channel < len(relays):
+                relays[channel]['ison'] = turn == 'on'
+                self._snapshot.mark_changed([device_id])
+        pending = self.pending_commands.get(key)
+        if pending is not None and pending['token'] == token:
+            # not superseded by a newer command
+            del self.pending_commands[key]
+            self.metrics.record_command_confirmation(time.monotonic() - pending['started'])
+            if turn is None:
+                _LOGGER.warning('device id ' + str(device_id) + ' channel ' + str(channel) +
+                                ': command failed, rolling back')
         if device_id in self.devices_status:
-            # get device status info
-            device_status_info = self.devices_status[device_id]
-            # check if the device is connected to the cloud
-            if device_status_info['cloud']['connected']:
-                # return the enabled value
-                return device_status_info['cloud']['enabled']
-        else:
-            _LOGGER.warning('get_device_availability() >>> device id ' +
-                            str(device_id) + ' not found')
-        # otherwise, return false
-        return False
-
-    def get_device_list(self):
+            self.update_device_state(device_id)
+        async_dispatcher_send(self._hass, SIGNAL_UPDATE_ENTITY.format(self.namespace, device_id), {'relays'})
+
+    def get_device_switch_status(self, device_id, channel, slot=None):
+        # a command not yet confirmed wins over the (possibly stale) polled status
+        pending = self.pending_commands.get((device_id, channel))
+        if pending is not None:
+            return pending['ison']
+        # the relay state (False if unknown), from the entity slot if given
+        if slot is None:
+            return self.state.relays.read(device_id, channel) == 1
+        return self.state.relays.data[slot] == 1
+
+    def get_device_availability(self, device_id, slot=None):
+        # a device answering on the LAN is available
+        if self.local is not None and self.local.is_reachable(device_id):
+            return True
+        # connected to the cloud and enabled (False if unknown), from the entity slot if given
+        if slot is None:
+            return self.state.available.read(device_id) == 1
+        return self.state.available.data[slot] == 1
+
+    def get_sensor_filter(self, sensor_type):
+        # publish filter of a sensor type (every change is published if not configured)
+        return self.sensor_filters.get(sensor_type, SENSOR_FILTER_NONE)
+
+    async def async_get_device_list(self):
+        # not logged in
+        if not self._data:
+            return False
         # device list url
         url = self._user_api_url + '/interface/device/list'
-        # get response
-        response = requests.post(url, headers={'Authorization': 'Bearer ' + self._data['token']})
         # get dict of POST response
-        data = response.json()
+        data = await self._async_request('POST', url)
+        if data is None:
+            _LOGGER.info('Device list failed')
+            return False
         # check if everything is Ok
         if data['isok']:
             _LOGGER.info('Device list successful')
@@ -322,76 +2187,211 @@ class ShellyCloudPlatform:
         else:
             # print errors
             _LOGGER.info('Device list failed')
-            errors = data['errors']
-            for error_title, error_message in errors.items():
-                _LOGGER.error(error_title + ' : ' + error_message)
+            self._log_errors(data)
         return False
 
-    def get_devices_status(self):
+    async def async_get_devices_status(self):
+        # not logged in
+        if not self._data:
+            return False
         # device list url
         url = self._user_api_url + '/device/all_status?_=' + str(time.time())
-        # get response
-        response = requests.get(url, headers={'Authorization': 'Bearer ' + self._data['token']})
-        # get dict of POST response
-        data = response.json()
+        # get dict of GET response (compact device records, streamed if possible)
+        if ijson is not None:
+            data = await self._async_request('GET', url, stream=async_stream_devices_status)
+        else:
+            data = await self._async_request('GET', url)
+            if data is not None and data['isok']:
+                devices_status = data['data']['devices_status']
+                data['data']['devices_status'] = {device_id: prune_device_status(device_status)
+                                                  for device_id, device_status in devices_status.items()}
+        if data is None:
+            return False
         # check if everything is Ok
         if data['isok']:
             # get_devices_status was succesful!
             return data['data']['devices_status']
         else:
-            # print errors
-            errors = data['errors']
-            for error_title, error_message in errors.items():
-                _LOGGER.error(error_title + ' : ' + error_message)
+            self._log_errors(data)
         return False
 
-    def set_device_channel(self, id, channel, turn):
+    async def async_get_device_status(self, device_id):
+        # not logged in
+        if not self._data:
+            return False
+        # device status url
+        url = self._user_api_url + '/device/status'
+        # get dict of POST response
+        data = await self._async_request('POST', url, {'id': device_id})
+        if data is None:
+            return False
+        # check if everything is Ok
+        if data['isok']:
+            return prune_device_status(data['data']['device_status'])
+        else:
+            self._log_errors(data)
+        return False
+
+    async def async_get_device_status_batch(self, device_ids):
+        # poll concurrently a few devices, returning {device id: status}
+        results = await asyncio.gather(*[self.async_get_device_status(device_id) for device_id in device_ids])
+        return {device_id: status for device_id, status in zip(device_ids, results) if status}
+
+    async def async_send_device_channel(self, id, channel, turn):
+        # send the command on the LAN if the device is reachable, through the Shelly Cloud otherwise
+        if self.local is not None:
+            result = await self.local.async_set_device_channel(id, channel, turn)
+            if result is not None:
+                return result
+        return await self.async_set_device_channel(id, channel, turn)
+
+    async def async_set_device_channel(self, id, channel, turn):
+        # not logged in
+        if not self._data:
+            return False
         # control url
-        url = 'https://shelly-2-eu.shelly.cloud/device/relay/control'
+        url = self._control_api_url + '/device/relay/control'
         # set POST https params
         params = {'id': id, 'channel': channel, 'turn': turn}
-        # get response
-        response = requests.post(url, params, headers = {'Authorization': 'Bearer ' + self._data['token']})
         # get dict of POST response
-        data = response.json()
+        data = await self._async_request('POST', url, params, priority=PRIORITY_COMMAND)
+        if data is None and self._control_api_url != self._user_api_url:
+            # the probed host failed: back to the user api, retrying the command there once
+            _LOGGER.warning('Shelly Cloud commands will be sent to ' + self._user_api_url)
+            self._control_api_url = self._user_api_url
+            url = self._control_api_url + '/device/relay/control'
+            data = await self._async_request('POST', url, params, priority=PRIORITY_COMMAND)
+        if data is None:
+            return False
         # check if everything is Ok
         if data['isok']:
             # set_device_channel was succesful!
             return True
         else:
-            # print errors
-            errors = data['errors']
-            for error_title, error_message in errors.items():
-                _LOGGER.error(error_title + ' : ' + error_message)
+            self._log_errors(data)
         return False
 
+    def get_metrics(self):
+        # metrics summary (JSON serializable)
+        metrics = self.metrics.as_dict()
+        metrics['rate_limiter'] = dict(self.rate_limiter.counters, rate=self.rate_limiter.rate)
+        return metrics
+
     def get_notifications_urls(self):
         if self._data:
-            return self._data['notifications_urls']
+            return self._data.get('notifications_urls')
+
+    @callback
+    def apply_device_status(self, device_id, delta):
+        # apply an incremental device status (e.g. from the notifications channel)
+        if device_id not in self.devices_status:
+            _LOGGER.debug('apply_device_status() >>> device id ' + str(device_id) + ' not found')
+            return False
+        self.devices_status[device_id] = prune_device_status(merge_device_status(self.devices_status[device_id], delta))
+        changed_keys = self.update_device_state(device_id)
+        self.add_device_samples(device_id)
+        if changed_keys:
+            async_dispatcher_send(self._hass, SIGNAL_UPDATE_ENTITY.format(self.namespace, device_id), changed_keys)
+            self._snapshot.mark_changed([device_id])
+            self.mark_devices_active([device_id])
+        return True
+
+    def register_entity(self, device_id, entity_id):
+        # add the entity id to the device entities
+        self.entities.setdefault(device_id, set()).add(entity_id)
+
+    def unregister_entity(self, device_id, entity_id):
+        # remove the entity id from the device entities
+        entity_ids = self.entities.get(device_id)
+        if entity_ids is not None:
+            entity_ids.discard(entity_id)
+            if not entity_ids:
+                del self.entities[device_id]
+
+    @callback
+    def remove_device_entities(self, device_id):
+        # ask every entity of the device to remove itself
+        for entity_id in list(self.entities.get(device_id, ())):
+            async_dispatcher_send(self._hass, SIGNAL_DELETE_ENTITY.format(entity_id))
+
+    def get_sensor_extractor(self, device_id):
+        # the extractor of the device shape, compiled on first use, cached per device
+        extractor = self._device_extractors.get(device_id)
+        if extractor is not None:
+            return extractor
+        device_status = self.devices_status[device_id]
+        device_type = self.devices.get(device_id, {}).get('type')
+        shape = get_status_shape(device_type, device_status)
+        extractor = self._sensor_extractors.get(shape)
+        if extractor is None:
+            extractor = ShellyCloudSensorExtractor(device_status)
+            self._sensor_extractors[shape] = extractor
+        self._device_extractors[device_id] = extractor
+        return extractor
+
+    def get_sensor_value(self, device_id, slot, value_slot=None):
+        # last raw value of the sensor slot (None if missing), from the entity value slot if given
+        if value_slot is None:
+            value = self.state.values.read(device_id, slot)
+        else:
+            value = self.state.values.data[value_slot]
+        if math.isnan(value):
+            return None
+        return value
+
+    def update_device_state(self, device_id):
+        # write the relay states, availability and sensor values of a device, returning the changed keys
+        device_status = self.devices_status[device_id]
+        return self.state.write_device(device_id, device_status, self.get_sensor_extractor(device_id))
+
+    def add_device_samples(self, device_id):
+        # a new status of the device (polled or notified) feeds the aggregates, unless the device is offline
+        # (its last values are stale: not integrated, the gap is skipped)
+        if self.aggregator is not None and self.get_device_availability(device_id):
+            self.aggregator.add_samples(device_id, self.state.get_sensor_values(device_id), time.time())
+
+    def update_devices_state(self, device_ids=None):
+        # write the values of the devices (all if None), returning {device id: changed keys}
+        changed_devices = {}
+        if device_ids is None:
+            device_ids = self.devices_status
+        for device_id in device_ids:
+            if device_id not in self.devices_status:
+                continue
+            changed_keys = self.update_device_state(device_id)
+            self.add_device_samples(device_id)
+            if changed_keys:
+                changed_devices[device_id] = changed_keys
+        return changed_devices
+
+    def discover_new_devices(self):
+        # discover the listed devices not yet discovered (every discovered device is listed)
+        if len(self._discovered_switches_device_ids) < len(self.devices):
+            self.discover_switches()
+        if len(self._discovered_sensors_device_ids) < len(self.devices):
+            self.discover_sensors()
 
     def discover_sensors(self):
-        if self.devices:
-            for device_id, device_info in self.devices.items():
-                if device_id not in self._discovered_sensors_device_ids:
-                    self._discovered_sensors_device_ids.append(device_id)
-                    self._hass.async_create_task(
-                        discovery.async_load_platform(self._hass,
-                                                      HA_SENSOR,
-                                                      DOMAIN,
-                                                      {'shelly_cloud_device_id': device_id},
-                                                      self._config))
+        self._discover_platform(HA_SENSOR, self._discovered_sensors_device_ids)
 
     def discover_switches(self):
+        self._discover_platform(HA_SWITCH, self._discovered_switches_device_ids)
+
+    def _discover_platform(self, platform, discovered_device_ids):
+        # load the platform once, with the whole batch of new device ids
         if self.devices:
-            for device_id, device_info in self.devices.items():
-                if device_id not in self._discovered_switches_device_ids:
-                    self._discovered_switches_device_ids.append(device_id)
-                    self._hass.async_create_task(
-                        discovery.async_load_platform(self._hass,
-                                                      HA_SWITCH,
-                                                      DOMAIN,
-                                                      {'shelly_cloud_device_id': device_id},
-                                                      self._config))
+            # devices without status are discovered once their status is known
+            new_device_ids = [device_id for device_id in self.devices
+                              if device_id not in discovered_device_ids and device_id in self.devices_status]
+            if new_device_ids:
+                discovered_device_ids.update(new_device_ids)
+                self._hass.async_create_task(
+                    discovery.async_load_platform(self._hass,
+                                                  platform,
+                                                  DOMAIN,
+                                                  {'shelly_cloud_device_ids': new_device_ids,
+                                                   'shelly_cloud_account': self.namespace},
+                                                  self._config))
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -404,8 +2404,18 @@ class ShellyCloudPlatform:
 class ShellyCloudEntity(Entity):
     # Shelly Cloud entity ( sensor / switch )
 
+    # logger of the entity traces (overridden by the sensor / switch entities)
+    _logger = _LOGGER
+
+    # one trace every _trace_sample_rate is logged for each entity (set from the account configuration)
+    _trace_sample_rate = DEFAULT_TRACE_SAMPLE_RATE
+
+    # traces of the entity so far (per instance once the first trace is counted)
+    _trace_count = 0
+
     def __init__(self,
                  hass,
+                 platform,
                  shelly_cloud_device_id,
                  shelly_cloud_device_name,
                  shelly_cloud_entity_id,
@@ -415,86 +2425,120 @@ class ShellyCloudEntity(Entity):
         self.hass = hass
         self.entity_id = shelly_cloud_entity_id
 
+        # platform of the Shelly Cloud account of the device, state store slot of the device availability
+        self._platform = platform
+        self._available_slot = platform.state.available.slot(shelly_cloud_device_id)
+        self._trace_sample_rate = platform.trace_sample_rate
+
         """Register the physical shelly_cloud device id"""
         self._shelly_cloud_device_id = shelly_cloud_device_id
         self._shelly_cloud_entity_name = shelly_cloud_entity_name
         self._shelly_cloud_device_name = shelly_cloud_device_name
         self._available = available
 
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' + self._shelly_cloud_entity_name + ' >>> __init__()')
+        # changed keys of the device the entity depends on (the sensor / switch entities add their own)
+        self._update_keys = {'cloud', 'name'}
+
+        # dispatcher disconnect functions
+        self._unsub_dispatchers = []
+
+        self._trace('__init__')
 
     async def async_added_to_hass(self):
         # Called when an entity has their entity_id and hass object assigned, before it is written to the state
         # machine for the first time. Example uses: restore the state or subscribe to updates.
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> async_added_to_hass()')
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> entity_id: ' +
-                      self.entity_id)
-        async_dispatcher_connect(self.hass,
-                                 SIGNAL_DELETE_ENTITY,
-                                 self._delete_callback)
-        async_dispatcher_connect(self.hass,
-                                 SIGNAL_UPDATE_ENTITY,
-                                 self._update_callback)
+        self._trace('async_added_to_hass')
+        self._unsub_dispatchers.append(
+            async_dispatcher_connect(self.hass,
+                                     SIGNAL_DELETE_ENTITY.format(self.entity_id),
+                                     self._delete_callback))
+        self._unsub_dispatchers.append(
+            async_dispatcher_connect(self.hass,
+                                     SIGNAL_UPDATE_ENTITY.format(self._platform.namespace,
+                                                                 self._shelly_cloud_device_id),
+                                     self._update_callback))
+        self._platform.register_entity(self._shelly_cloud_device_id, self.entity_id)
         return True
 
     async def async_will_remove_from_hass(self):
         # Called when an entity is about to be removed from Home Assistant. Example use: disconnect from the server or
         # unsubscribe from updates
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> async_will_remove_from_hass()')
+        self._trace('async_will_remove_from_hass')
+        for unsub_dispatcher in self._unsub_dispatchers:
+            unsub_dispatcher()
+        self._unsub_dispatchers = []
+        self._platform.unregister_entity(self._shelly_cloud_device_id, self.entity_id)
         return True
 
     async def async_update(self):
         # update is done in the update function
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> async_update()')
+        self._trace('async_update')
         return True
 
+    @property
+    def should_poll(self):
+        # no polling: the platform wakes up the entity when its device changes
+        return False
+
     @property
     def device_id(self):
         # Return shelly_cloud device id.
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> device_id() >>> ' +
-                      self._shelly_cloud_device_id)
+        self._trace('device_id', self._shelly_cloud_device_id)
         return self._shelly_cloud_device_id
 
     @property
     def unique_id(self):
         # Return a unique ID."
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> unique_id() >>> ' +
-                      self.entity_id)
+        self._trace('unique_id', self.entity_id)
         return self.entity_id
 
     @property
     def name(self):
         # Return shelly_cloud device name.
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> name() >>> ' +
-                      self._shelly_cloud_device_name)
+        self._trace('name', self._shelly_cloud_device_name)
         return self._shelly_cloud_device_name
 
     @property
     def available(self):
         # Return if the device is available.
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> available() >>> ' +
-                      str(self._available))
+        self._trace('available', self._available)
         return self._available
 
     @callback
-    def _delete_callback(self, entity_id):
+    def _delete_callback(self):
         # Remove this entity.
-        if entity_id == self.entity_id:
-            _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                          self._shelly_cloud_entity_name + ' >>> _delete_callback()')
-            self.hass.async_create_task(self.async_remove())
+        self._trace('_delete_callback')
+        self.hass.async_create_task(self.async_delete())
+
+    async def async_delete(self):
+        # remove the state, then the entity registry entry (it has a unique id: it would be left as an orphan)
+        await self.async_remove()
+        registry = await entity_registry.async_get_registry(self.hass)
+        if registry.async_is_registered(self.entity_id):
+            registry.async_remove(self.entity_id)
 
     @callback
-    def _update_callback(self):
-        # Call update method.
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> _update_callback()')
-        self.async_schedule_update_ha_state(True)
\ No newline at end of file
+    def _update_callback(self, changed_keys=None):
+        # Call update method, unless none of the changed keys of the device is used by the entity (None: update)
+        if changed_keys is not None and self._update_keys.isdisjoint(changed_keys):
+            return
+        self._trace('_update_callback')
+        if changed_keys and 'name' in changed_keys:
+            # the device has been renamed
+            device_info = self._platform.devices.get(self._shelly_cloud_device_id, {})
+            self._shelly_cloud_device_name = device_info.get('name', self._shelly_cloud_device_name)
+        self.async_schedule_update_ha_state(True)
+
+    def _trace(self, method, value=None):
+        # per-entity debug trace: formatted only if debug is enabled, sampled one every _trace_sample_rate
+        if not self._logger.isEnabledFor(logging.DEBUG):
+            return
+        self._trace_count += 1
+        if self._trace_count % self._trace_sample_rate:
+            return
+        if value is None:
+            self._logger.debug('%s >>> %s >>> %s()',
+                               self._shelly_cloud_device_name, self._shelly_cloud_entity_name, method)
+        else:
+            self._logger.debug('%s >>> %s >>> %s() >>> %s',
+                               self._shelly_cloud_device_name, self._shelly_cloud_entity_name, method, value)
@@ -0,0 +1,96 @@
+"""Microbenchmark of the entity property getters read by HA on every state write.
+
+Run from the HA configuration directory:
+
+    python -m custom_components.shelly_cloud.bench.entity_properties
+
+It compares the eager string concatenation previously done by the getters with the lazy, level-aware traces
+(ShellyCloudEntity._trace), with the debug log disabled and enabled.
+"""
+import logging
+import timeit
+
+from custom_components.shelly_cloud.switch import ShellyCloudSwitchEntity
+
+_LOGGER = logging.getLogger('shelly_cloud_switch')
+
+NUMBER = 200000
+
+
+class EagerSwitchEntity:
+    # reference: the getters as they were, building the debug message on every read
+
+    def __init__(self):
+        self._shelly_cloud_device_name = 'Living room'
+        self._shelly_cloud_entity_name = '0'
+        self._shelly_cloud_device_id = 'a1b2c3d4e5f6'
+        self._available = True
+        self._is_on = True
+        self.entity_id = 'switch.shelly_cloud_a1b2c3d4e5f6'
+
+    @property
+    def name(self):
+        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
+                      self._shelly_cloud_entity_name + ' >>> name() >>> ' +
+                      self._shelly_cloud_device_name)
+        return self._shelly_cloud_device_name
+
+    @property
+    def unique_id(self):
+        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
+                      self._shelly_cloud_entity_name + ' >>> unique_id() >>> ' +
+                      self.entity_id)
+        return self.entity_id
+
+    @property
+    def available(self):
+        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
+                      self._shelly_cloud_entity_name + ' >>> available() >>> ' +
+                      str(self._available))
+        return self._available
+
+    @property
+    def is_on(self):
+        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
+                      self._shelly_cloud_device_name + ' >>> is_on() >>> ' +
+                      str(self._is_on))
+        return self._is_on
+
+
+def lazy_switch_entity():
+    # a switch entity with the attributes read by the getters, without hass
+    entity = ShellyCloudSwitchEntity.__new__(ShellyCloudSwitchEntity)
+    entity._shelly_cloud_device_name = 'Living room'
+    entity._shelly_cloud_entity_name = '0'
+    entity._shelly_cloud_device_id = 'a1b2c3d4e5f6'
+    entity._available = True
+    entity._is_on = True
+    entity.entity_id = 'switch.shelly_cloud_a1b2c3d4e5f6'
+    return entity
+
+
+def read_properties(entity):
+    return entity.name, entity.unique_id, entity.available, entity.is_on
+
+
+def main():
+    # discard the debug records: only their formatting cost is measured
+    handler = logging.NullHandler()
+    _LOGGER.addHandler(handler)
+    _LOGGER.propagate = False
+
+    entities = {'eager': EagerSwitchEntity(), 'lazy': lazy_switch_entity()}
+    for level in (logging.WARNING, logging.DEBUG):
+        _LOGGER.setLevel(level)
+        for sample_rate in ((1,) if level == logging.WARNING else (1, 100)):
+            entities['lazy']._trace_sample_rate = sample_rate
+            for kind, entity in entities.items():
+                if kind == 'eager' and sample_rate != 1:
+                    continue
+                seconds = timeit.timeit(lambda: read_properties(entity), number=NUMBER)
+                print('{:<7} {:<6} sample 1/{:<4} {:8.3f} us per read of the 4 properties'.format(
+                    logging.getLevelName(level), kind, sample_rate, seconds / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""Fake Shelly Cloud server, serving synthetic devices on the local host.
+
+It answers the requests done by the custom-component (login, device list, devices status, relay control) with
+configurable latency, error rate and churn, so that the component can be measured without a Shelly account.
+
+Used by the platform_scale benchmark, or run standalone and point a test HA instance to it with `api_url`:
+
+    python -m custom_components.shelly_cloud.bench.fake_cloud --devices 500 --port 8090
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+
+from aiohttp import web
+
+# device models: type, relays, meters, emeters, inputs, sensors (tmp, hum, bat)
+DEVICE_MODELS = (
+    ('SHSW-1', 1, 0, 0, 1, False),
+    ('SHSW-PM', 1, 1, 0, 1, False),
+    ('SHSW-25', 2, 2, 0, 2, False),
+    ('SHPLG-S', 1, 1, 0, 0, False),
+    ('SHEM', 1, 0, 2, 0, False),
+    ('SHHT-1', 0, 0, 0, 0, True),
+)
+
+
+class FakeShellyCloud:
+
+    def __init__(self, devices=100, latency=0.05, error_rate=0.0, churn=0.05, list_churn=0.0, seed=1):
+
+        # behaviour: mean response latency (seconds), failed requests and changed devices (fractions)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.churn = churn
+        self.list_churn = list_churn
+        self._random = random.Random(seed)
+
+        # synthetic devices: device id -> device info, device id -> device status
+        self.devices = {}
+        self.devices_status = {}
+        self._next_device = 0
+        for _ in range(devices):
+            self._add_device()
+
+        # served requests by path, relay commands received
+        self.requests = {}
+        self.commands = 0
+
+        self._runner = None
+        self.url = None
+
+    def _add_device(self):
+        model, relays, meters, emeters, inputs, sensors = DEVICE_MODELS[self._next_device % len(DEVICE_MODELS)]
+        device_id = '{:012x}'.format(0xb0b000000000 + self._next_device)
+        self._next_device += 1
+        self.devices[device_id] = {'id': device_id,
+                                   'type': model,
+                                   'name': model + ' ' + device_id[-4:],
+                                   'ip': ''}
+        status = {'cloud': {'enabled': True, 'connected': True}}
+        if relays:
+            status['relays'] = [{'ison': False} for _ in range(relays)]
+        if meters:
+            status['meters'] = [{'power': 0.0, 'total': 0} for _ in range(meters)]
+        if emeters:
+            status['emeters'] = [{'power': 0.0, 'voltage': 230.0, 'current': 0.0, 'pf': 1.0,
+                                  'total': 0.0, 'total_returned': 0.0} for _ in range(emeters)]
+        if inputs:
+            status['inputs'] = [{'input': 0} for _ in range(inputs)]
+        if sensors:
+            status['tmp'] = {'value': 21.0}
+            status['hum'] = {'value': 50.0}
+            status['bat'] = {'value': 100}
+        self.devices_status[device_id] = status
+
+    def _change_device(self, device_id):
+        # a random change of a watched value
+        status = self.devices_status[device_id]
+        if 'relays' in status and self._random.random() < 0.5:
+            relay = self._random.choice(status['relays'])
+            relay['ison'] = not relay['ison']
+        for meter in status.get('meters', []) + status.get('emeters', []):
+            meter['power'] = round(self._random.uniform(0, 2000), 2)
+            meter['total'] += self._random.randint(1, 100)
+        if 'tmp' in status:
+            status['tmp']['value'] = round(self._random.uniform(15, 30), 1)
+        if self._random.random() < 0.01:
+            status['cloud']['connected'] = not status['cloud']['connected']
+
+    def _churn_devices_status(self):
+        for device_id in self._random.sample(list(self.devices_status), int(len(self.devices_status) * self.churn)):
+            self._change_device(device_id)
+
+    def _churn_devices(self):
+        # replace some devices with new ones
+        for device_id in self._random.sample(list(self.devices), int(len(self.devices) * self.list_churn)):
+            del self.devices[device_id]
+            del self.devices_status[device_id]
+            self._add_device()
+
+    async def _async_respond(self, request, data):
+        self.requests[request.path] = self.requests.get(request.path, 0) + 1
+        await asyncio.sleep(self.latency * self._random.uniform(0.5, 1.5))
+        if self._random.random() < self.error_rate:
+            if self._random.random() < 0.5:
+                return web.Response(status=503)
+            return web.json_response({'isok': False, 'errors': {'max_req': 'Request limit reached!'}})
+        return web.json_response({'isok': True, 'data': data})
+
+    async def _async_login(self, request):
+        # unsigned JWT, valid for one day, no notifications channel
+        payload = json.dumps({'exp': int(time.time()) + 86400}).encode()
+        token = 'e30.' + base64.urlsafe_b64encode(payload).decode().rstrip('=') + '.fake'
+        return await self._async_respond(request, {'token': token,
+                                                   'user_api_url': self.url,
+                                                   'notifications_urls': []})
+
+    async def _async_device_list(self, request):
+        self._churn_devices()
+        return await self._async_respond(request, {'devices': self.devices})
+
+    async def _async_all_status(self, request):
+        self._churn_devices_status()
+        return await self._async_respond(request, {'devices_status': self.devices_status})
+
+    async def _async_device_status(self, request):
+        form = await request.post()
+        device_id = form.get('id')
+        if device_id not in self.devices_status:
+            return web.json_response({'isok': False, 'errors': {'wrong_id': 'Device not found'}})
+        if self._random.random() < self.churn:
+            self._change_device(device_id)
+        return await self._async_respond(request, {'device_status': self.devices_status[device_id]})
+
+    async def _async_relay_control(self, request):
+        form = await request.post()
+        status = self.devices_status.get(form.get('id'), {})
+        channel = int(form.get('channel', 0))
+        if channel < len(status.get('relays', ())):
+            status['relays'][channel]['ison'] = form.get('turn') == 'on'
+            self.commands += 1
+        return await self._async_respond(request, None)
+
+    async def async_start(self, host='127.0.0.1', port=0):
+        # start serving, returning the base url (a free port if 0)
+        app = web.Application()
+        app.router.add_post('/auth/login', self._async_login)
+        app.router.add_post('/interface/device/list', self._async_device_list)
+        app.router.add_get('/device/all_status', self._async_all_status)
+        app.router.add_post('/device/status', self._async_device_status)
+        app.router.add_post('/device/relay/control', self._async_relay_control)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = 'http://' + host + ':' + str(port)
+        return self.url
+
+    async def async_stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.05, help='mean response latency (seconds)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of failed requests')
+    parser.add_argument('--churn', type=float, default=0.05, help='fraction of devices changed per status poll')
+    parser.add_argument('--list-churn', type=float, default=0.0, help='fraction of devices replaced per list')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+async def async_main(args):
+    cloud = FakeShellyCloud(args.devices, args.latency, args.error_rate, args.churn, args.list_churn, args.seed)
+    url = await cloud.async_start(args.host, args.port)
+    print('Fake Shelly Cloud with ' + str(args.devices) + ' devices at ' + url + ' (any username / password)')
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await cloud.async_stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    add_arguments(parser)
+    try:
+        asyncio.get_event_loop().run_until_complete(async_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""Scale benchmark of the platform and its entities, against the fake Shelly Cloud server.
+
+Run from the HA configuration directory (the storage files are written to a temporary directory):
+
+    python -m custom_components.shelly_cloud.bench.platform_scale --devices 10 100 1000 5000
+
+For each number of synthetic devices it sets up the component in a bare HA core, then reports:
+- setup: time to the first poll with all the entities added, memory per entity (platform and entities);
+- poll: wall time of a poll of all the devices, longest and total event loop blocking, state writes per poll;
+- commands: switch commands per second, toggling up to --commands switches with a single service call.
+"""
+import argparse
+import asyncio
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from homeassistant import config_entries
+from homeassistant.core import HomeAssistant, CoreState
+from homeassistant.setup import async_setup_component
+
+from custom_components.shelly_cloud import DOMAIN, HA_SWITCH
+from custom_components.shelly_cloud.bench.fake_cloud import FakeShellyCloud, add_arguments
+
+# event loop lag sampling period (seconds)
+LAG_SAMPLE_INTERVAL = 0.005
+
+
+class LoopLagMonitor:
+    # measures how long the event loop is blocked, as the delay of a periodic sleep
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._task = None
+        self.max_lag = 0
+        self.total_lag = 0
+
+    def reset(self):
+        self.max_lag = 0
+        self.total_lag = 0
+
+    def start(self):
+        self._task = self._loop.create_task(self._async_run())
+
+    async def _async_run(self):
+        while True:
+            start = self._loop.time()
+            await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+            lag = self._loop.time() - start - LAG_SAMPLE_INTERVAL
+            if lag > 0:
+                self.max_lag = max(self.max_lag, lag)
+                self.total_lag += lag
+
+    async def async_stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def async_create_hass(config_dir):
+    # a bare HA core, loading the custom components of the current directory
+    hass = HomeAssistant()
+    hass.config.config_dir = config_dir
+    hass.config.skip_pip = True
+    hass.config_entries = config_entries.ConfigEntries(hass, {})
+    await hass.config_entries.async_initialize()
+    hass.state = CoreState.running
+    return hass
+
+
+def count_state_writes(hass):
+    # wrap the state machine to count the state writes
+    counter = {'writes': 0}
+    async_set = hass.states.async_set
+
+    def counting_async_set(*args, **kwargs):
+        counter['writes'] += 1
+        return async_set(*args, **kwargs)
+
+    hass.states.async_set = counting_async_set
+    return counter
+
+
+async def async_check_float_values(platform, cloud):
+    # the (streamed) all_status keeps the non-integer values as floats, and the sensors read them
+    devices_status = await platform.async_get_devices_status()
+    assert devices_status, 'all_status failed'
+    checked = 0
+    for device_id, device_status in devices_status.items():
+        if 'tmp' not in device_status:
+            continue
+        value = device_status['tmp']['value']
+        assert isinstance(value, float), 'tmp of ' + device_id + ' parsed as ' + type(value).__name__
+        assert value == cloud.devices_status[device_id]['tmp']['value'], 'tmp of ' + device_id + ' differs'
+        assert platform.get_sensor_value(device_id, ('tmp', None)) is not None, 'tmp of ' + device_id + ' not read'
+        checked += 1
+    print('      check float values of {} device(s) OK'.format(checked))
+
+
+async def async_run(args, devices):
+    cloud = FakeShellyCloud(devices, args.latency, args.error_rate, args.churn, args.list_churn, args.seed)
+    api_url = await cloud.async_start()
+    config_dir = tempfile.mkdtemp()
+    hass = await async_create_hass(config_dir)
+    lag = LoopLagMonitor(hass.loop)
+    lag.start()
+    try:
+        config = {DOMAIN: {'username': 'bench@example.com',
+                           'password': 'bench',
+                           'api_url': api_url,
+                           'rate_limit': 10000,
+                           'rate_limit_burst': 10000,
+                           # the polls are run by the benchmark
+                           'scan_interval': 86400,
+                           'priority_scan_interval': 86400,
+                           'idle_scan_interval': 86400,
+                           'shelly_cloud_devices_scan_interval': 86400}}
+
+        # setup: login, device list, first status, entities
+        tracemalloc.start()
+        start = time.monotonic()
+        await async_setup_component(hass, DOMAIN, config)
+        await hass.async_block_till_done()
+        setup_time = time.monotonic() - start
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        platform = next(iter(hass.data[DOMAIN].values()))
+        entities = sum(len(entity_ids) for entity_ids in platform.entities.values())
+        print('{:>5} devices {:>6} entities  setup {:7.3f} s  {:7.0f} B/entity'.format(
+            devices, entities, setup_time, memory / max(entities, 1)))
+        await async_check_float_values(platform, cloud)
+
+        # polls of all the devices
+        writes = count_state_writes(hass)
+        for poll in range(args.polls):
+            if args.list_churn:
+                await platform.async_discover_devices()
+            # all the devices due
+            platform._device_next_poll.clear()
+            writes['writes'] = 0
+            lag.reset()
+            start = time.monotonic()
+            await platform.async_update_devices()
+            await hass.async_block_till_done()
+            print('      poll {:>2}  {:7.3f} s  loop blocked max {:6.1f} ms total {:7.1f} ms  {:>6} writes'.format(
+                poll, time.monotonic() - start, lag.max_lag * 1000, lag.total_lag * 1000, writes['writes']))
+
+        # switch commands
+        entity_ids = [entity_id for device_entity_ids in platform.entities.values()
+                      for entity_id in device_entity_ids if entity_id.startswith(HA_SWITCH + '.')][:args.commands]
+        if entity_ids:
+            commands = cloud.commands
+            start = time.monotonic()
+            await hass.services.async_call(HA_SWITCH, 'toggle', {'entity_id': entity_ids}, blocking=True)
+            await hass.async_block_till_done()
+            duration = time.monotonic() - start
+            print('      commands {:>5}  {:7.3f} s  {:8.1f} commands/s'.format(
+                cloud.commands - commands, duration, (cloud.commands - commands) / duration))
+
+        print('      requests ' + ', '.join(path + ' ' + str(count) for path, count in sorted(cloud.requests.items())))
+    finally:
+        await lag.async_stop()
+        await hass.async_stop()
+        await cloud.async_stop()
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+
+async def async_main(args):
+    for devices in args.devices:
+        await async_run(args, devices)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    parser.add_argument('--polls', type=int, default=5, help='polls of all the devices')
+    parser.add_argument('--commands', type=int, default=100, help='switches toggled at once')
+    add_arguments(parser)
+    asyncio.get_event_loop().run_until_complete(async_main(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,32 @@
 import logging
+import time
 from datetime import timedelta
 from homeassistant.components.sensor import ENTITY_ID_FORMAT
-from custom_components.shelly_cloud import (DOMAIN, ShellyCloudEntity)
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.helpers.entity import Entity
+from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.restore_state import RestoreEntity
+import homeassistant.util.dt as dt_util
+from custom_components.shelly_cloud import (DOMAIN, SIGNAL_UPDATE_METRICS, SIGNAL_UPDATE_AGGREGATES, AGGREGATED_SENSORS,
+                                            ShellyCloudEntity, shelly_cloud_SENSORS_MAP, format_window)
 
 # Setting log
 _LOGGER = logging.getLogger('shelly_cloud_sensor')
-_LOGGER.setLevel(logging.DEBUG)
-
-# define the HA scan for sensor
-SCAN_INTERVAL = timedelta(seconds=10)
-
-shelly_cloud_SENSORS_MAP = {
-    'bat': {'eid': 'battery', 'uom': '%', 'icon': 'mdi:battery', 'factor': 1, 'decimals': 2},
-    'hum': {'eid': 'humidity', 'uom': '%', 'icon': 'mdi:water-percent', 'factor': 1, 'decimals': 2},
-    'tmp':  {'eid': 'temperature', 'uom': '°C', 'icon': 'mdi:temperature-celsius', 'factor': 1, 'decimals': 2},
-    'power':  {'eid': 'power', 'uom': 'W', 'icon': 'mdi:flash-outline', 'factor': 0.001,'decimals': 2},
-    'current': {'eid': 'current', 'uom': 'A', 'icon': 'mdi:current-ac', 'factor': 0.001,'decimals': 2},
-    'voltage': {'eid': 'voltage', 'uom': 'V', 'icon': 'mdi:power-plug', 'factor': 0.1,  'decimals': 2},
+
+
+# diagnostic sensors: metric -> entity id suffix, unit of measurement, icon, value from the platform metrics
+shelly_cloud_DIAGNOSTIC_SENSORS_MAP = {
+    'poll_duration': {'eid': 'poll_duration', 'uom': 's', 'icon': 'mdi:timer-outline',
+                      'value': lambda metrics: metrics.poll_duration.last},
+    'poll_duration_p95': {'eid': 'poll_duration_p95', 'uom': 's', 'icon': 'mdi:timer-outline',
+                          'value': lambda metrics: metrics.poll_duration.percentile(0.95)},
+    'devices_changed': {'eid': 'devices_changed', 'uom': 'devices', 'icon': 'mdi:swap-horizontal',
+                        'value': lambda metrics: metrics.devices_changed},
+    'command_rtt_p95': {'eid': 'command_rtt_p95', 'uom': 's', 'icon': 'mdi:timer-outline',
+                        'value': lambda metrics: metrics.command_rtt.percentile(0.95)},
+    'api_errors': {'eid': 'api_errors', 'uom': 'errors', 'icon': 'mdi:alert-circle-outline',
+                   'value': lambda metrics: metrics.errors_count},
 }
 
 
@@ -27,99 +37,358 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
     if discovery_info is None:
         _LOGGER.warning('async_setup_platform >>> discovery_info is None')
         pass
+    elif discovery_info.get('shelly_cloud_diagnostics'):
+        # diagnostic sensors of the platform
+        platform = hass.data[DOMAIN][discovery_info['shelly_cloud_account']]
+        async_add_entities([ShellyCloudDiagnosticSensorEntity(hass, platform, metric)
+                            for metric in shelly_cloud_DIAGNOSTIC_SENSORS_MAP],
+                           update_before_add=False)
     else:
         ha_entities = []
 
-        # get shelly device id
-        shelly_cloud_device_id = discovery_info.get('shelly_cloud_device_id')
-        # check if shelly is in the device list
-        if shelly_cloud_device_id not in hass.data[DOMAIN].devices:
-            # error: the device id is not in the list...
-            keys = str(hass.data[DOMAIN].devices.keys())
-            _LOGGER.error('device id ' + shelly_cloud_device_id + ' is not in ' + keys)
-        else:
-            # get the shelly_cloud device info
-            shelly_cloud_device_info = hass.data[DOMAIN].devices[shelly_cloud_device_id]
-            # get the shelly_cloud device status
-            shelly_cloud_device_status = hass.data[DOMAIN].devices_status[shelly_cloud_device_id]
-            # get the shelly_cloud device name
-            shelly_cloud_device_name = shelly_cloud_device_info['name']
-            for shelly_cloud_sensor_name in shelly_cloud_SENSORS_MAP:
-                if shelly_cloud_sensor_name in shelly_cloud_device_status:
-                    _LOGGER.info('registering sensor: '
-                                 'id: ' + shelly_cloud_device_id + ', ' +
-                                 'name: ' + shelly_cloud_device_name + ', ' +
-                                 'sensor: ' + shelly_cloud_sensor_name)
-                    # creiamo una entità Home Assistant di tipo ShellyCloudSensorEntity
-                    sensor = ShellyCloudSensorEntity(hass,
-                                                     shelly_cloud_device_id,
-                                                     shelly_cloud_device_name,
-                                                     shelly_cloud_sensor_name)
-                    # aggiungiamola alle entità da aggiungere
-                    ha_entities.append(sensor)
+        # platform of the Shelly Cloud account
+        platform = hass.data[DOMAIN][discovery_info['shelly_cloud_account']]
+
+        # get the batch of shelly device ids
+        for shelly_cloud_device_id in discovery_info.get('shelly_cloud_device_ids', []):
+            ha_entities.extend(get_device_sensors(hass, platform, shelly_cloud_device_id))
 
+        # add all the entities at once
         if len(ha_entities) > 0:
-            async_add_entities(ha_entities, update_before_add=False)
+            # the update reads the values already extracted by the platform (no I/O)
+            async_add_entities(ha_entities, update_before_add=True)
 
     _LOGGER.debug('async_setup_platform <<< terminated')
 
     return True
 
 
+def get_device_sensors(hass, platform, shelly_cloud_device_id):
+
+    ha_entities = []
+
+    # check if shelly is in the device list
+    if shelly_cloud_device_id not in platform.devices:
+        # error: the device id is not in the list...
+        _LOGGER.error('device id ' + shelly_cloud_device_id + ' is not in the device list')
+    else:
+        # get the shelly_cloud device info
+        shelly_cloud_device_info = platform.devices[shelly_cloud_device_id]
+        # get the shelly_cloud device name
+        shelly_cloud_device_name = shelly_cloud_device_info['name']
+        # get the sensors of the device model (one per channel for meters, emeters and inputs)
+        if shelly_cloud_device_id in platform.devices_status:
+            extractor = platform.get_sensor_extractor(shelly_cloud_device_id)
+            for (shelly_cloud_sensor_name, shelly_cloud_sensor_channel), _ in extractor.paths:
+                suffix = ''
+                if extractor.channels[(shelly_cloud_sensor_name, shelly_cloud_sensor_channel)] > 1:
+                    suffix = '_' + str(shelly_cloud_sensor_channel)
+                _LOGGER.info('registering sensor: '
+                             'id: ' + shelly_cloud_device_id + ', ' +
+                             'name: ' + shelly_cloud_device_name + ', ' +
+                             'sensor: ' + shelly_cloud_sensor_name + suffix)
+                # creiamo una entità Home Assistant di tipo ShellyCloudSensorEntity
+                sensor = ShellyCloudSensorEntity(hass,
+                                                 platform,
+                                                 shelly_cloud_device_id,
+                                                 shelly_cloud_device_name,
+                                                 shelly_cloud_sensor_name,
+                                                 shelly_cloud_sensor_channel,
+                                                 suffix)
+                # aggiungiamola alle entità da aggiungere
+                ha_entities.append(sensor)
+                # rolling aggregates of the sensor: energy (powers only), min / max / mean over each window
+                if platform.aggregator is not None and shelly_cloud_sensor_name in AGGREGATED_SENSORS:
+                    aggregates = [('energy', None)] if sensor.unit_of_measurement == 'W' else []
+                    aggregates.extend((kind, window)
+                                      for window in platform.aggregator.windows for kind in ('min', 'max', 'mean'))
+                    for kind, window in aggregates:
+                        ha_entities.append(ShellyCloudAggregateSensorEntity(hass,
+                                                                            platform,
+                                                                            shelly_cloud_device_id,
+                                                                            shelly_cloud_device_name,
+                                                                            shelly_cloud_sensor_name,
+                                                                            shelly_cloud_sensor_channel,
+                                                                            suffix,
+                                                                            kind,
+                                                                            window))
+
+    return ha_entities
+
+
 class ShellyCloudSensorEntity(ShellyCloudEntity):
 
-    def __init__(self, hass, shelly_cloud_device_id, shelly_cloud_device_name, shelly_cloud_sensor_name):
-        # attributes
+    _logger = _LOGGER
+
+    def __init__(self,
+                 hass,
+                 platform,
+                 shelly_cloud_device_id,
+                 shelly_cloud_device_name,
+                 shelly_cloud_sensor_name,
+                 shelly_cloud_sensor_channel=None,
+                 suffix=''):
+        # attributes: the sensor metadata, the last raw value and the (cached) scaled value
+        self._descriptor = shelly_cloud_SENSORS_MAP[shelly_cloud_sensor_name]
+        self._slot = (shelly_cloud_sensor_name, shelly_cloud_sensor_channel)
+        self._value_slot = platform.state.values.slot(shelly_cloud_device_id, self._slot)
+        self._raw_value = None
         self._value = 0
         self._shelly_cloud_sensor_name = shelly_cloud_sensor_name
+        # publish filter: the scaled value waiting to be published, when (monotonic) the state was last published,
+        # the timer re-evaluating a held back value
+        self._filter = platform.get_sensor_filter(shelly_cloud_sensor_name)
+        self._pending_value = None
+        self._published_at = None
+        self._unsub_publish_timer = None
 
         # naming
-        shelly_cloud_sensor_id = "{}_{}_{}".format(DOMAIN,
-                                                   shelly_cloud_device_id,
-                                                   shelly_cloud_SENSORS_MAP[shelly_cloud_sensor_name]['eid'])
+        shelly_cloud_sensor_id = "{}_{}_{}{}".format(platform.namespace,
+                                                     shelly_cloud_device_id,
+                                                     self._descriptor.eid,
+                                                     suffix)
         shelly_cloud_entity_id = ENTITY_ID_FORMAT.format(shelly_cloud_sensor_id)
 
         # init ShellyCloudEntity
-        shelly_cloud_device_online = hass.data[DOMAIN].get_device_availability(shelly_cloud_device_id)
+        shelly_cloud_device_online = platform.get_device_availability(shelly_cloud_device_id)
         super().__init__(hass,
+                         platform,
                          shelly_cloud_device_id,
                          shelly_cloud_device_name,
                          shelly_cloud_entity_id,
-                         shelly_cloud_sensor_name,
+                         shelly_cloud_sensor_name + suffix,
                          shelly_cloud_device_online)
+        self._update_keys.add(self._slot)
 
     async def async_update(self):
         id = self._shelly_cloud_device_id
-        sensor = self._shelly_cloud_sensor_name
-        self._value = self.hass.data[DOMAIN].devices_status[id][sensor]['value']
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> async_update() >>> ' +
-                      str(self._value))
+        # the raw values are extracted once per poll by the platform
+        raw_value = self._platform.get_sensor_value(id, self._slot, self._value_slot)
+        # scale only when the raw value changes
+        if raw_value is not None and raw_value != self._raw_value:
+            self._raw_value = raw_value
+            self._pending_value = self._descriptor.scale(raw_value)
+        self._filter_value()
+        self._available = self._platform.get_device_availability(id, self._available_slot)
+        self._trace('async_update', self._value)
         return True
 
+    def _filter_value(self):
+        # publish the pending value if it passes the filter, otherwise re-evaluate it when it could
+        if self._pending_value is None:
+            return
+        now = time.monotonic()
+        if self._published_at is None:
+            # the first value
+            delay = 0
+        elif self._pending_value == self._value:
+            # back to the published value
+            self._pending_value = None
+            return
+        elif self._filter.exceeds(self._pending_value, self._value):
+            # a meaningful change, but not more often than min_interval
+            delay = 0
+            if self._filter.min_interval is not None:
+                delay = self._published_at + self._filter.min_interval - now
+        elif self._filter.max_interval is not None:
+            # a change within the deadbands, published at most max_interval later
+            delay = self._published_at + self._filter.max_interval - now
+        else:
+            # a change within the deadbands, held back until a meaningful one
+            return
+        # a single timer, for the latest pending value
+        if self._unsub_publish_timer is not None:
+            self._unsub_publish_timer()
+            self._unsub_publish_timer = None
+        if delay > 0:
+            self._unsub_publish_timer = async_call_later(self.hass, delay, self._publish_timer_callback)
+            return
+        self._value = self._pending_value
+        self._pending_value = None
+        self._published_at = now
+
+    @callback
+    def _publish_timer_callback(self, now):
+        self._unsub_publish_timer = None
+        self.async_schedule_update_ha_state(True)
+
+    async def async_will_remove_from_hass(self):
+        if self._unsub_publish_timer is not None:
+            self._unsub_publish_timer()
+            self._unsub_publish_timer = None
+        return await super().async_will_remove_from_hass()
+
     @property
     def unit_of_measurement(self):
-        uom = shelly_cloud_SENSORS_MAP[self._shelly_cloud_sensor_name]['uom']
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> unit_of_measurement() >>> ' +
-                      uom)
+        self._trace('unit_of_measurement', self._descriptor.uom)
         # Return the unit of measurement.
-        return uom
+        return self._descriptor.uom
 
     @property
     def icon(self):
-        icon = shelly_cloud_SENSORS_MAP[self._shelly_cloud_sensor_name]['icon']
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> icon() >>> ' +
-                      str(icon))
+        self._trace('icon', self._descriptor.icon)
         # Return the icon.
-        return icon
+        return self._descriptor.icon
+
+    @property
+    def state(self):
+        # Return the scaled value (a number), computed in async_update.
+        self._trace('state', self._value)
+        return self._value
+
+
+class ShellyCloudAggregateSensorEntity(RestoreEntity, ShellyCloudEntity):
+
+    _logger = _LOGGER
+
+    def __init__(self,
+                 hass,
+                 platform,
+                 shelly_cloud_device_id,
+                 shelly_cloud_device_name,
+                 shelly_cloud_sensor_name,
+                 shelly_cloud_sensor_channel,
+                 suffix,
+                 kind,
+                 window=None):
+        # attributes: the sensor metadata, the aggregate kind (energy, min, max, mean) and window (seconds)
+        self._descriptor = shelly_cloud_SENSORS_MAP[shelly_cloud_sensor_name]
+        self._slot = (shelly_cloud_sensor_name, shelly_cloud_sensor_channel)
+        self._kind = kind
+        self._window = window
+        self._value = None
+        self._series = None
+
+        # naming
+        aggregate_name = kind
+        if window is not None:
+            aggregate_name += '_' + format_window(timedelta(seconds=window))
+        shelly_cloud_sensor_id = "{}_{}_{}{}_{}".format(platform.namespace,
+                                                        shelly_cloud_device_id,
+                                                        self._descriptor.eid,
+                                                        suffix,
+                                                        aggregate_name)
+        shelly_cloud_entity_id = ENTITY_ID_FORMAT.format(shelly_cloud_sensor_id)
+
+        # init ShellyCloudEntity
+        shelly_cloud_device_online = platform.get_device_availability(shelly_cloud_device_id)
+        super().__init__(hass,
+                         platform,
+                         shelly_cloud_device_id,
+                         shelly_cloud_device_name,
+                         shelly_cloud_entity_id,
+                         shelly_cloud_sensor_name + suffix + ' ' + aggregate_name.replace('_', ' '),
+                         shelly_cloud_device_online)
+
+    async def async_added_to_hass(self):
+        await super().async_added_to_hass()
+        # refreshed periodically, the aggregates change even if the device does not
+        self._unsub_dispatchers.append(
+            async_dispatcher_connect(self.hass,
+                                     SIGNAL_UPDATE_AGGREGATES.format(self._platform.namespace),
+                                     self._update_callback))
+        # the integrated energy continues from its last value
+        if self._kind == 'energy':
+            last_state = await self.async_get_last_state()
+            if last_state is not None:
+                try:
+                    energy = float(last_state.state)
+                except ValueError:
+                    return
+                self._platform.aggregator.restore_energy(self._shelly_cloud_device_id, self._slot, energy)
+
+    async def async_update(self):
+        aggregate = self._platform.aggregator.get_aggregate(self._shelly_cloud_device_id, self._slot)
+        if aggregate is not None:
+            if self._kind == 'energy':
+                self._value = round(aggregate.energy, 3)
+            else:
+                now = dt_util.utcnow().timestamp()
+                stats = aggregate.stats(self._window, now)
+                if stats is not None:
+                    self._value = round(stats[('min', 'max', 'mean').index(self._kind)], self._descriptor.decimals)
+                if self._kind == 'mean':
+                    decimals = self._descriptor.decimals
+                    self._series = [[dt_util.utc_from_timestamp(start).isoformat(), round(mean, decimals)]
+                                    for start, mean in aggregate.series(self._window, now)]
+        self._available = self._platform.get_device_availability(self._shelly_cloud_device_id, self._available_slot)
+        self._trace('async_update', self._value)
+        return True
+
+    @property
+    def unit_of_measurement(self):
+        if self._kind == 'energy':
+            return 'kWh'
+        return self._descriptor.uom
+
+    @property
+    def icon(self):
+        if self._kind == 'energy':
+            return 'mdi:counter'
+        return self._descriptor.icon
+
+    @property
+    def state(self):
+        self._trace('state', self._value)
+        return self._value
+
+    @property
+    def device_state_attributes(self):
+        # downsampled series of the window (mean sensors)
+        if self._series is None:
+            return None
+        return {'series': self._series}
+
+
+class ShellyCloudDiagnosticSensorEntity(Entity):
+
+    def __init__(self, hass, platform, metric):
+        self.hass = hass
+        self._platform = platform
+        self._metric = metric
+        self.entity_id = ENTITY_ID_FORMAT.format("{}_{}".format(platform.namespace,
+                                                                shelly_cloud_DIAGNOSTIC_SENSORS_MAP[metric]['eid']))
+        self._unsub_dispatcher = None
+
+    async def async_added_to_hass(self):
+        self._unsub_dispatcher = async_dispatcher_connect(self.hass,
+                                                         SIGNAL_UPDATE_METRICS.format(self._platform.namespace),
+                                                         self._update_callback)
+
+    async def async_will_remove_from_hass(self):
+        if self._unsub_dispatcher is not None:
+            self._unsub_dispatcher()
+
+    @callback
+    def _update_callback(self):
+        self.async_schedule_update_ha_state()
+
+    @property
+    def should_poll(self):
+        # updated by the platform after each poll
+        return False
+
+    @property
+    def unique_id(self):
+        return self.entity_id
+
+    @property
+    def name(self):
+        if self._platform.name is not None:
+            return 'Shelly Cloud ' + self._platform.name + ' ' + self._metric.replace('_', ' ')
+        return 'Shelly Cloud ' + self._metric.replace('_', ' ')
+
+    @property
+    def unit_of_measurement(self):
+        return shelly_cloud_DIAGNOSTIC_SENSORS_MAP[self._metric]['uom']
+
+    @property
+    def icon(self):
+        return shelly_cloud_DIAGNOSTIC_SENSORS_MAP[self._metric]['icon']
 
     @property
     def state(self):
-        f = shelly_cloud_SENSORS_MAP[self._shelly_cloud_sensor_name]['factor']
-        formatted_value = '{:.{d}f}'.format(self._value*f, d=shelly_cloud_SENSORS_MAP[self._shelly_cloud_sensor_name]['decimals'])
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> state() >>> ' +
-                      formatted_value)
-        return formatted_value
+        value = shelly_cloud_DIAGNOSTIC_SENSORS_MAP[self._metric]['value'](self._platform.metrics)
+        if isinstance(value, float):
+            return round(value, 3)
+        return value
@@ -1,14 +1,9 @@
 import logging
-from datetime import timedelta
 from homeassistant.components.switch import ENTITY_ID_FORMAT, SwitchDevice
 from custom_components.shelly_cloud import (DOMAIN, ShellyCloudEntity)
 
 # Setting log
 _LOGGER = logging.getLogger('shelly_cloud_switch')
-_LOGGER.setLevel(logging.DEBUG)
-
-# define the HA scan for switch
-SCAN_INTERVAL = timedelta(seconds=5)
 
 
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
@@ -21,40 +16,14 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
     else:
         ha_entities = []
 
-        # get shelly device id
-        shelly_cloud_device_id = discovery_info.get('shelly_cloud_device_id')
-        # check if shelly is in the device list
-        if shelly_cloud_device_id not in hass.data[DOMAIN].devices:
-            # error: the device id is not in the list...
-            keys = str(hass.data[DOMAIN].devices.keys())
-            _LOGGER.error('uuid ' + shelly_cloud_device_id + ' is not in ' + keys)
-        else:
-            # get the shelly_cloud device info
-            shelly_cloud_device_info = hass.data[DOMAIN].devices[shelly_cloud_device_id]
-            # get the shelly_cloud device status
-            shelly_cloud_device_status = hass.data[DOMAIN].devices_status[shelly_cloud_device_id]
-            # get the shelly_cloud device name
-            shelly_cloud_device_name = shelly_cloud_device_info['name']
-            if 'relays' in shelly_cloud_device_status:
-                # get the num of channels
-                channels = len(shelly_cloud_device_status['relays'])
-                for shelly_cloud_switch_channel in range(0, channels):
-                    suffix = ''
-                    if channels > 1:
-                        suffix = '_'+str(shelly_cloud_switch_channel)
-                    # creiamo una entità Home Assistant di tipo ShellyCloudSwitchEntity
-                    _LOGGER.info('registering switch: '
-                                 'id ' + shelly_cloud_device_id + ', ' +
-                                 'name ' + shelly_cloud_device_name + ', ' +
-                                 'channel ' + str(shelly_cloud_switch_channel))
-                    switch = ShellyCloudSwitchEntity(hass,
-                                                     shelly_cloud_device_id,
-                                                     shelly_cloud_device_name,
-                                                     shelly_cloud_switch_channel,
-                                                     suffix)
-                    # aggiungiamola alle entità da aggiungere
-                    ha_entities.append(switch)
+        # platform of the Shelly Cloud account
+        platform = hass.data[DOMAIN][discovery_info['shelly_cloud_account']]
+
+        # get the batch of shelly device ids
+        for shelly_cloud_device_id in discovery_info.get('shelly_cloud_device_ids', []):
+            ha_entities.extend(get_device_switches(hass, platform, shelly_cloud_device_id))
 
+        # add all the entities at once
         if len(ha_entities) > 0:
             async_add_entities(ha_entities, update_before_add=False)
 
@@ -63,79 +32,130 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
     return True
 
 
+def get_device_switches(hass, platform, shelly_cloud_device_id):
+
+    ha_entities = []
+
+    # check if shelly is in the device list
+    if shelly_cloud_device_id not in platform.devices:
+        # error: the device id is not in the list...
+        _LOGGER.error('uuid ' + shelly_cloud_device_id + ' is not in the device list')
+    else:
+        # get the shelly_cloud device info
+        shelly_cloud_device_info = platform.devices[shelly_cloud_device_id]
+        # get the shelly_cloud device status
+        shelly_cloud_device_status = platform.devices_status.get(shelly_cloud_device_id, {})
+        # get the shelly_cloud device name
+        shelly_cloud_device_name = shelly_cloud_device_info['name']
+        if 'relays' in shelly_cloud_device_status:
+            # get the num of channels
+            channels = len(shelly_cloud_device_status['relays'])
+            for shelly_cloud_switch_channel in range(0, channels):
+                suffix = ''
+                if channels > 1:
+                    suffix = '_'+str(shelly_cloud_switch_channel)
+                # creiamo una entità Home Assistant di tipo ShellyCloudSwitchEntity
+                _LOGGER.info('registering switch: '
+                             'id ' + shelly_cloud_device_id + ', ' +
+                             'name ' + shelly_cloud_device_name + ', ' +
+                             'channel ' + str(shelly_cloud_switch_channel))
+                switch = ShellyCloudSwitchEntity(hass,
+                                                 platform,
+                                                 shelly_cloud_device_id,
+                                                 shelly_cloud_device_name,
+                                                 shelly_cloud_switch_channel,
+                                                 suffix)
+                # aggiungiamola alle entità da aggiungere
+                ha_entities.append(switch)
+
+    return ha_entities
+
+
 class ShellyCloudSwitchEntity(ShellyCloudEntity, SwitchDevice):
 
-    def __init__(self, hass, shelly_cloud_device_id, shelly_cloud_device_name, shelly_cloud_switch_channel, suffix):
+    _logger = _LOGGER
 
-        # attributes
-        self._is_on = hass.data[DOMAIN].get_device_switch_status(shelly_cloud_device_id, shelly_cloud_switch_channel)
+    def __init__(self, hass, platform, shelly_cloud_device_id, shelly_cloud_device_name, shelly_cloud_switch_channel,
+                 suffix):
+
+        # attributes (the relay state is read from its state store slot)
+        self._relay_slot = platform.state.relays.slot(shelly_cloud_device_id, shelly_cloud_switch_channel)
+        self._is_on = platform.get_device_switch_status(shelly_cloud_device_id,
+                                                        shelly_cloud_switch_channel,
+                                                        self._relay_slot)
         self._shelly_cloud_switch_channel = shelly_cloud_switch_channel
         self._shelly_cloud_device_id = shelly_cloud_device_id
 
         # naming
         shelly_cloud_switch_name = str(shelly_cloud_switch_channel)
-        shelly_cloud_switch_id = "{}_{}{}".format(DOMAIN, shelly_cloud_device_id, suffix)
+        shelly_cloud_switch_id = "{}_{}{}".format(platform.namespace, shelly_cloud_device_id, suffix)
         shelly_cloud_entity_id = ENTITY_ID_FORMAT.format(shelly_cloud_switch_id)
-        _LOGGER.debug(shelly_cloud_device_name + ' >>> ' + shelly_cloud_switch_name + ' >>> __init__()')        
 
         # init ShellyCloudEntity
-        shelly_cloud_device_online = hass.data[DOMAIN].get_device_availability(shelly_cloud_device_id)
+        shelly_cloud_device_online = platform.get_device_availability(shelly_cloud_device_id)
         super().__init__(hass,
+                         platform,
                          shelly_cloud_device_id,
                          shelly_cloud_device_name,
                          shelly_cloud_entity_id,
                          shelly_cloud_switch_name,
                          shelly_cloud_device_online)
+        self._update_keys.add('relays')
 
-    async def async_execute_switch_and_set_status(self):
+    async def async_execute_switch_and_set_status(self, is_on, token):
         id = self._shelly_cloud_device_id
         channel = self._shelly_cloud_switch_channel
-        if self._is_on:
-            self.hass.data[DOMAIN].set_device_channel(id, channel, 'on')
-        else:
-            self.hass.data[DOMAIN].set_device_channel(id, channel, 'off')
-        self.hass.data[DOMAIN].devices_status[id]['relays'][channel]['ison'] = self._is_on
+        # queued commands are dispatched together, a newer command on the same channel replaces this one
+        turn = await self._platform.commands.async_submit(id, channel, 'on' if is_on else 'off')
+        # confirm (or roll back) the optimistic state
+        self._platform.end_command(id, channel, token, turn)
+        if turn is None:
+            _LOGGER.error(self._shelly_cloud_device_name + ' >>> ' +
+                          self._shelly_cloud_entity_name + ' >>> switch command failed')
+            return False
         return True
 
+    def _switch(self, is_on):
+        # optimistic: the new state is shown right away, stale polls are ignored until the command is confirmed
+        token = self._platform.begin_command(self._shelly_cloud_device_id,
+                                             self._shelly_cloud_switch_channel,
+                                             is_on)
+        self._is_on = is_on
+        self.async_schedule_update_ha_state()
+        return self.hass.async_create_task(self.async_execute_switch_and_set_status(is_on, token))
+
     async def async_turn_on(self):
-        self._is_on = True
         _LOGGER.info(self._shelly_cloud_device_name + ' >>> ' +
                      self._shelly_cloud_entity_name + ' >>> async_turn_on()')
-        return self.hass.async_add_job(self.async_execute_switch_and_set_status)
+        return self._switch(True)
 
     async def async_turn_off(self):
-        self._is_on = False
         _LOGGER.info(self._shelly_cloud_device_name + ' >>> ' +
                      self._shelly_cloud_entity_name + ' >>> async_turn_off()')
-        return self.hass.async_add_job(self.async_execute_switch_and_set_status)
+        return self._switch(False)
 
     async def async_update(self):
         id = self._shelly_cloud_device_id
         channel = self._shelly_cloud_switch_channel
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> async_update()')
-        updated_is_on = self.hass.data[DOMAIN].get_device_switch_status(id, channel)
+        self._trace('async_update')
+        updated_is_on = self._platform.get_device_switch_status(id, channel, self._relay_slot)
         if updated_is_on != self._is_on:
             _LOGGER.info(self._shelly_cloud_device_name + ' >>> ' +
                          self._shelly_cloud_entity_name + ' >>> switching from ' +
                          str(self._is_on) + ' to ' +
                          str(updated_is_on))
         self._is_on = updated_is_on
-        self._available = self.hass.data[DOMAIN].get_device_availability(id)
+        self._available = self._platform.get_device_availability(id, self._available_slot)
         return True
 
     @property
     def name(self):
         """Name of the device."""
-        _LOGGER.debug(self._shelly_cloud_device_name + ' >>> ' +
-                      self._shelly_cloud_entity_name + ' >>> name() >>> ' +
-                      self._shelly_cloud_device_name)
+        self._trace('name', self._shelly_cloud_device_name)
         return self._shelly_cloud_device_name
 
     @property
     def is_on(self):
-        _LOGGER.debug(self._shelly_cloud_device_name+' >>> ' +
-                      self._shelly_cloud_device_name + ' >>> is_on() >>> ' +
-                      str(self._is_on))
+        self._trace('is_on', self._is_on)
         return self._is_on
 